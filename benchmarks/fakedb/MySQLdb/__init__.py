@@ -0,0 +1,95 @@
+# -*- coding: utf8 -*-
+"""
+In-process stand-in for MySQL-python used by the benchmarks. It never opens a socket.
+
+Every execute() sleeps for `latency` seconds (a simulated network round trip) and
+answers with `responder(sql)`, which returns a dict with the keys rows, description,
+rowcount and lastrowid. A list of such dicts answers a multi-statement query, and an
+exception instance is raised from execute() instead.
+"""
+from MySQLdb import cursors
+from MySQLdb.constants import FIELD_TYPE
+
+threadsafety = 1
+latency = 0.0
+responder = None
+
+
+class Error(Exception):
+    pass
+
+
+class InterfaceError(Error):
+    pass
+
+
+class DatabaseError(Error):
+    pass
+
+
+class OperationalError(DatabaseError):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+def _escape(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    return "'%s'" % str(value).replace('\\', '\\\\').replace("'", "\\'")
+
+
+class Connection(object):
+    _thread_ids = [0]
+
+    def __init__(self, *args, **kwargs):
+        self.cursorclass = kwargs.get('cursorclass') or cursors.Cursor
+        self.autocommit_mode = True
+        Connection._thread_ids[0] += 1
+        self._thread_id = Connection._thread_ids[0]
+
+    def autocommit(self, flag):
+        self.autocommit_mode = flag
+
+    def get_autocommit(self):
+        return self.autocommit_mode
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def set_server_option(self, option):
+        pass
+
+    def thread_id(self):
+        return self._thread_id
+
+    def ping(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def literal(self, value):
+        if isinstance(value, dict):
+            return dict((key, _escape(item)) for key, item in value.items())
+        if isinstance(value, (tuple, list)):
+            return tuple(_escape(item) for item in value)
+        return _escape(value)
+
+    def cursor(self, cursorclass=None):
+        return (cursorclass or self.cursorclass)(self)
+
+
+def connect(*args, **kwargs):
+    return Connection(*args, **kwargs)
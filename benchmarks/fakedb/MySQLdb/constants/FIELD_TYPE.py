@@ -0,0 +1,20 @@
+DECIMAL = 0
+TINY = 1
+SHORT = 2
+LONG = 3
+FLOAT = 4
+DOUBLE = 5
+NULL = 6
+TIMESTAMP = 7
+LONGLONG = 8
+INT24 = 9
+DATE = 10
+TIME = 11
+DATETIME = 12
+YEAR = 13
+VARCHAR = 15
+BIT = 16
+NEWDECIMAL = 246
+BLOB = 252
+VAR_STRING = 253
+STRING = 254
@@ -0,0 +1,78 @@
+# -*- coding: utf8 -*-
+import time
+
+
+class Cursor(object):
+    _dict = False
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = 0
+        self.lastrowid = None
+        self._last_executed = ''
+        self._rows = ()
+        self._position = 0
+        self._sets = []
+
+    def execute(self, query, args=None):
+        import MySQLdb
+        if args is not None:
+            query = query % self.connection.literal(args)
+        self._last_executed = query
+        if MySQLdb.latency:
+            time.sleep(MySQLdb.latency)
+        result = MySQLdb.responder(query) if MySQLdb.responder else {}
+        if isinstance(result, list):
+            result, self._sets = result[0], result[1:]
+        self._load(result)
+        return self.rowcount
+
+    def _load(self, result):
+        if isinstance(result, Exception):
+            raise result
+        self.description = result.get('description')
+        rows = result.get('rows', ())
+        if self._dict and self.description:
+            names = [column[0] for column in self.description]
+            rows = [dict(zip(names, row)) for row in rows]
+        self._rows, self._position = rows, 0
+        self.rowcount = result.get('rowcount', len(rows))
+        self.lastrowid = result.get('lastrowid')
+
+    def nextset(self):
+        if not self._sets:
+            return None
+        self._load(self._sets.pop(0))
+        return 1
+
+    def fetchone(self):
+        if self._position >= len(self._rows):
+            return None
+        self._position += 1
+        return self._rows[self._position - 1]
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._position:self._position + size]
+        self._position += len(rows)
+        return tuple(rows)
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        return tuple(rows)
+
+    def close(self):
+        pass
+
+
+class DictCursor(Cursor):
+    _dict = True
+
+
+class SSCursor(Cursor):
+    pass
+
+
+class SSDictCursor(DictCursor):
+    pass
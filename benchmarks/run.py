@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""
+lazy_mysql 性能基准，使用 benchmarks/fakedb 中的 MySQLdb 替身，无需数据库服务器。
+
+    python benchmarks/run.py                          # 打印结果
+    python benchmarks/run.py --json result.json       # 保存为 JSON
+    python benchmarks/run.py --baseline base.json     # 与基线比较，出现退化时返回 1
+
+所有指标均为越大越好（次/秒或行/秒）。
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, 'fakedb'), os.path.dirname(HERE)]
+
+import MySQLdb
+from MySQLdb.constants import FIELD_TYPE
+import lazy_mysql
+from lazy_mysql import Engine, Pool, Table
+
+BENCHMARKS = []
+
+
+def benchmark(name, unit='ops/s'):
+    """注册基准函数，函数返回 (次数, 耗时秒数) 或 {子项名称: (次数, 耗时秒数)}。"""
+    def register(fn):
+        BENCHMARKS.append((name, unit, fn))
+        return fn
+    return register
+
+
+def timed(fn, min_time, repeat=3):
+    """反复执行 fn 至少 min_time 秒，取 repeat 轮中最快的一轮，返回 (次数, 耗时秒数)。"""
+    best = None
+    for _ in range(repeat):
+        count, started = 0, time.time()
+        while True:
+            fn()
+            count += 1
+            elapsed = time.time() - started
+            if elapsed >= min_time:
+                break
+        if best is None or count / elapsed > best[0] / best[1]:
+            best = count, elapsed
+    return best
+
+
+def respond(rows=(), description=None, rowcount=None, lastrowid=None):
+    result = {'rows': rows, 'description': description, 'lastrowid': lastrowid}
+    result['rowcount'] = len(rows) if rowcount is None else rowcount
+    return lambda sql: result
+
+
+def schedule(engine):
+    return Table('schedule', engine, 'schedule_id', 'task_id', 'task_name', 'status', 'score')
+
+
+SCHEDULE_DESCRIPTION = (('schedule_id', FIELD_TYPE.LONG), ('task_id', FIELD_TYPE.LONG),
+                        ('task_name', FIELD_TYPE.VAR_STRING), ('status', FIELD_TYPE.TINY),
+                        ('score', FIELD_TYPE.DOUBLE))
+
+
+def schedule_rows(count):
+    return [(index, index % 97, 'task-%d' % (index % 1000), index % 3, index * 0.5) for index in range(count)]
+
+
+@benchmark('column')
+def bench_column(options):
+    s = schedule(None)
+    ids = range(100)
+    return {
+        'eq': timed(lambda: s.schedule_id == 5, options.min_time),
+        'like': timed(lambda: s.task_name.like('query%'), options.min_time),
+        'between': timed(lambda: s.score.between(1, 2), options.min_time),
+        'in_100': timed(lambda: s.schedule_id.in_(*ids), options.min_time),
+    }
+
+
+@benchmark('build')
+def bench_build(options):
+    s = schedule(None)
+    return {
+        'select': timed(lambda: s.select(s.task_name, s.status).where(s.schedule_id == 1, s.status > 0)
+                        .order(s.task_id, desc=True).limit(10)._statement(), options.min_time),
+        'update': timed(lambda: s.update(task_name='query', status=1).where(s.schedule_id == 1)._statement(),
+                        options.min_time),
+        'delete': timed(lambda: s.delete().where(s.schedule_id == 1)._statement(), options.min_time),
+        'count': timed(lambda: s.count().where(s.status == 1)._statement(), options.min_time),
+    }
+
+
+@benchmark('go')
+def bench_go(options):
+    """会话 go() 的完整开销：语句构造、借还 Engine、执行与结果转换，驱动本身不耗时。"""
+    MySQLdb.latency = 0
+    MySQLdb.responder = respond(schedule_rows(1), SCHEDULE_DESCRIPTION, lastrowid=1)
+    engine = Engine('localhost', 'bench', 'user', 'pw', debug=False)
+    pool = Pool('localhost', 'bench', 'user', 'pw', debug=False)
+    s, p = schedule(engine), schedule(pool)
+    return {
+        'select_engine': timed(lambda: s.select().where(s.schedule_id == 1).go(), options.min_time),
+        'select_pool': timed(lambda: p.select().where(p.schedule_id == 1).go(), options.min_time),
+        'insert_pool': timed(lambda: p.insert(task_name='query', status=1).go(), options.min_time),
+        'count_pool': timed(lambda: p.count().where(p.status == 1).go(), options.min_time),
+        'compiled_pool': timed(_compiled(p), options.min_time),
+    }
+
+
+def _compiled(s):
+    statement = s.select().where(s.schedule_id == lazy_mysql.Param('id')).compile()
+    return lambda: statement.go(id=1)
+
+
+@benchmark('pool')
+def bench_pool(options):
+    """多线程竞争 Pool.get()/put()，返回全部线程合计的次/秒。"""
+    results = {}
+    for threads in options.threads:
+        pool = Pool('localhost', 'bench', 'user', 'pw', debug=False, pool_size=4, extras=4, wait_time=30)
+        per_thread = max(options.pool_cycles // threads, 1)
+        start = threading.Event()
+
+        def work():
+            start.wait()
+            for _ in range(per_thread):
+                pool.put(pool.get())
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        started = time.time()
+        start.set()
+        for worker in workers:
+            worker.join()
+        results['threads_%02d' % threads] = per_thread * threads, time.time() - started
+        pool.close()
+    return results
+
+
+@benchmark('fetch', 'rows/s')
+def bench_fetch(options):
+    """大结果集的读取速度。"""
+    rows = schedule_rows(options.rows)
+    MySQLdb.latency = 0
+    MySQLdb.responder = respond(rows, SCHEDULE_DESCRIPTION)
+    engine = Engine('localhost', 'bench', 'user', 'pw', debug=False)
+    s = schedule(engine)
+
+    def fetch(fn):
+        count, elapsed = timed(fn, options.min_time, repeat=2)
+        return count * len(rows), elapsed
+
+    def iterate():
+        for _ in s.select().limit().iter(chunk_size=1000):
+            pass
+
+    results = {
+        'dict': fetch(lambda: s.select().limit().go()),
+        'tuple': fetch(lambda: s.select().limit().go('tuple')),
+        'record': fetch(lambda: s.select().limit().go('record')),
+        'iter': fetch(iterate),
+        'columnar': fetch(lambda: s.select().limit().go_columnar(use_numpy=lazy_mysql.numpy is not None)),
+    }
+    return results
+
+
+@benchmark('round_trips')
+def bench_round_trips(options):
+    """模拟网络延迟下执行 10 条独立语句，比较逐条执行、管道与并行执行，单位为组/秒。"""
+    MySQLdb.latency = options.latency / 1000.0
+    single = respond(schedule_rows(1), SCHEDULE_DESCRIPTION)
+    MySQLdb.responder = lambda sql: [single(sql)] * (sql.count(';') + 1)
+    pool = Pool('localhost', 'bench', 'user', 'pw', debug=False, pool_size=10, extras=0)
+    s = schedule(pool)
+
+    def sessions():
+        return [s.select().where(s.schedule_id == index) for index in range(10)]
+
+    try:
+        return {
+            'sequential': timed(lambda: [session.go() for session in sessions()], options.min_time, repeat=1),
+            'pipeline': timed(lambda: pool.pipeline().add(*sessions()).go(), options.min_time, repeat=1),
+            'gather': timed(lambda: pool.gather(sessions()), options.min_time, repeat=1),
+        }
+    finally:
+        MySQLdb.latency = 0
+        pool.close()
+
+
+def run(options):
+    results = {}
+    for name, unit, fn in BENCHMARKS:
+        if options.only and name not in options.only:
+            continue
+        measured = fn(options)
+        if isinstance(measured, tuple):
+            measured = {'': measured}
+        for case, (count, elapsed) in sorted(measured.items()):
+            key = '%s.%s' % (name, case) if case else name
+            results[key] = {'value': count / elapsed, 'unit': unit, 'count': count, 'seconds': round(elapsed, 6)}
+            sys.stderr.write('%-28s %14.1f %s\n' % (key, count / elapsed, unit))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """与基线比较，返回退化的指标名称列表。"""
+    regressions = []
+    sys.stderr.write('\n%-28s %14s %14s %8s\n' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        old, new = baseline[key]['value'], results[key]['value']
+        ratio = new / old if old else float('inf')
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        sys.stderr.write('%-28s %14.1f %14.1f %7.2fx%s\n' % (key, old, new, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='lazy_mysql benchmarks against an in-process fake MySQLdb')
+    parser.add_argument('--only', nargs='*', help='run only these benchmark groups')
+    parser.add_argument('--json', help='write the results as JSON to this file, - for stdout')
+    parser.add_argument('--baseline', help='compare against a JSON file written by --json')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown before a regression')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per measurement round')
+    parser.add_argument('--rows', type=int, default=100000, help='rows returned by the fetch benchmark')
+    parser.add_argument('--latency', type=float, default=1.0, help='simulated round trip in ms for round_trips')
+    parser.add_argument('--threads', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--pool-cycles', type=int, default=64000, help='total get/put cycles per thread count')
+    options = parser.parse_args(argv)
+
+    results = run(options)
+    document = {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                 'version': lazy_mysql.__version__, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'results': results,
+    }
+    if options.json == '-':
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    elif options.json:
+        with open(options.json, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, options.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,19 +14,57 @@ It provides five SQL operations, they are SELECT, INSERT, DELETE, UPDATE, COUNT.
 条件支持 WHERE, ORDER BY, GROUP BY, DISTINCT, LIMIT。
 """
 __author__ = 'Xavier Yin'
-__version__ = '1.2.6'
-__date__ = '2015-4-1'
+__version__ = '1.3.0'
+__date__ = '2026-10-18'
 
 
 from datetime import datetime
+from itertools import chain, count, islice
+from operator import itemgetter
 from MySQLdb import cursors
+from MySQLdb.constants import FIELD_TYPE
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from heapq import heapify, heappop, heappush, heapreplace
 from Queue import Queue, Full, Empty
-from threading import RLock
+from threading import RLock, Thread, Event, Condition, local
+import atexit
+import hashlib
+import json
+import keyword
 import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+import time
+import weakref
+import zlib
 import MySQLdb
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 MySQLdb.threadsafety = 1
 logger = logging.getLogger(__name__)
+_clock = getattr(time, 'monotonic', time.time)
+
+_STREAMING_CURSORS = {cursors.DictCursor: cursors.SSDictCursor, cursors.Cursor: cursors.SSCursor}
+# connections inherited from a parent process, their sockets replaced by /dev/null in
+# this process; kept referenced so they are only freed at interpreter exit
+_inherited_connections = []
+_fork_lock = RLock()
+
+
+def _check_detachable(connection):
+    """检查从父进程继承的连接能否安全丢弃：需要 Connection.fileno()，MySQL-python 1.2.5 没有该方法。"""
+    if connection is not None and not hasattr(connection, 'fileno'):
+        raise RuntimeError('cannot detach a connection inherited from the parent process: the driver has no '
+                           'Connection.fileno(), use mysqlclient, or close the pool before forking')
 
 
 class Engine(object):
@@ -40,12 +78,17 @@ class Engine(object):
         :param pw: 密码。
         :param port: 端口。
         :param charset: 字符集。
-        :param cursor_class: 游标类，默认值为 dict，其他为 tuple。
+        :param cursor_class: 行格式，dict, tuple 或 record，默认值为 dict。
         :param autocommit: 自动提交。
         :param debug: 调试模式。
         :param args: 其他参数。
-        :param kwargs: 其他参数。
+        :param kwargs: 其他参数，其中 row_format 为 cursor_class 的别名，
+                       local_infile 为真时允许 LOAD DATA LOCAL INFILE（Table.load_from() 需要），
+                       query_timeout 为会话未调用 timeout() 时默认的语句超时毫秒数。
         """
+        cursor_class = kwargs.pop('row_format', cursor_class)
+        self.local_infile = kwargs.pop('local_infile', False)
+        self.query_timeout = kwargs.pop('query_timeout', None)
         self.host = host
         self.schema = schema
         self.user = user
@@ -60,6 +103,16 @@ class Engine(object):
         self.kwargs = kwargs
         self.affected_rows = 0
         self.last_executed = ''
+        self._max_allowed_packet = None
+        self.connected_at = None
+        self.last_used = _clock()
+        self._tx = None
+        self._pid = None    # process that opened the connection
+
+    @property
+    def row_format(self):
+        """行格式：dict, tuple 或 record。"""
+        return self._cursor_class if self._cursor_class in ('dict', 'record') else 'tuple'
 
     @property
     def cursor_class(self):
@@ -72,22 +125,52 @@ class Engine(object):
     def cursor_class(self, _class):
         self._cursor_class = _class
 
-    def connect(self, cursor_class=None):
-        """建立数据库连接。"""
+    def connect(self, cursor_class=None, streaming=False):
+        """建立数据库连接。
+        :param cursor_class: 游标类型，None 表示使用 self.cursor_class。
+        :param streaming: 为真时使用服务器端游标（SSCursor/SSDictCursor）。
+        """
+        if self.connection is not None and self._pid != os.getpid():
+            self._abandon()
         if not self.connection:
+            options = {'local_infile': 1} if self.local_infile else {}
             self.connection = MySQLdb.connect(
                 self.host, self.user, self.pw, self.schema, port=self.port,
-                charset=self.charset, cursorclass=cursor_class)
+                charset=self.charset, cursorclass=cursor_class, **options)
             self.connection.autocommit(self.autocommit)
+            self.connected_at = _clock()
+            self._pid = os.getpid()
         if cursor_class is None:
             self.connection.cursorclass = self.cursor_class
         elif cursor_class == "dict":
             self.connection.cursorclass = cursors.DictCursor
         else:
             self.connection.cursorclass = cursors.Cursor
+        if streaming:
+            self.connection.cursorclass = _STREAMING_CURSORS[self.connection.cursorclass]
         return self.connection
 
+    @property
+    def max_allowed_packet(self):
+        """服务器允许的最大数据包字节数，首次读取后缓存。"""
+        if self._max_allowed_packet is None:
+            cursor = self.connect().cursor(cursors.Cursor)
+            cursor.execute('SELECT @@max_allowed_packet')
+            self._max_allowed_packet = int(cursor.fetchone()[0])
+            cursor.close()
+        return self._max_allowed_packet
+
+    def transaction(self):
+        """返回显式事务的上下文管理器，见 Pool.transaction()。"""
+        return _Transaction(self)
+
+    def pipeline(self):
+        """返回语句管道，见 Pool.pipeline()。"""
+        return _Pipeline(self)
+
     def close(self):
+        if self.connection is not None and self._pid != os.getpid():
+            return self._abandon()
         try:
             self.connection.close()
         except Exception as e:
@@ -95,6 +178,26 @@ class Engine(object):
                 logger.exception(str(e))
         finally:
             self.connection = None
+            self.connected_at = None
+
+    def _abandon(self):
+        """
+        丢弃从父进程继承的连接：父进程仍在使用同一个套接字，先用 /dev/null 覆盖本进程中的文件描述符，
+        之后无论何时释放连接对象，COM_QUIT 都只会写入 /dev/null。驱动不支持时抛出 RuntimeError。
+        """
+        _check_detachable(self.connection)
+        try:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            try:
+                os.dup2(devnull, self.connection.fileno())
+            finally:
+                os.close(devnull)
+        except (MySQLdb.Error, OSError) as e:
+            logger.warning('cannot detach inherited connection: %s', e)
+        _inherited_connections.append(self.connection)
+        self.connection = None
+        self.connected_at = None
+        self._tx = None
 
     def create_database(self, table_name, confirm=False):
         """创建新的数据库。
@@ -137,7 +240,8 @@ class Engine(object):
 
     def _transaction(self, sql, fetch=False, cursor_class=None):
         """不要直接调用本方法，执行SQL语句并返回结果。"""
-        self.affected_rows, self.last_executed, timestamp = 0, '', datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.affected_rows, self.last_executed = 0, ''
+        timestamp = _timestamp() if self.debug and logger.isEnabledFor(logging.DEBUG) else None
         try:
             conn = self.connect(cursor_class)
             cursor = conn.cursor()
@@ -145,13 +249,15 @@ class Engine(object):
         except Exception as e:
             if self.debug:
                 logger.exception(str(e))
+            if not _connection_lost(e):
+                raise
             self.close()
             conn = self.connect(cursor_class)
             cursor = conn.cursor()
             self.affected_rows = cursor.execute(sql)
 
         self.last_executed = cursor._last_executed
-        if self.debug:
+        if timestamp is not None:
             logger.debug('%s : %s ROW(S) AFFECTED WITH SQL: %s', timestamp, self.affected_rows, self.last_executed)
         result = cursor.fetchall() if fetch else self.affected_rows
         cursor.close()
@@ -162,7 +268,8 @@ class Pool(object):
 
     def __init__(self, host, schema, user, pw, port=3306, charset='utf8',
                  cursor_class='dict', autocommit=True, debug=True, pool_size=2,
-                 extras=4, wait_time=5, *args, **kwargs):
+                 extras=4, wait_time=5, min_idle=0, max_idle_time=None, max_lifetime=None, prewarm=False,
+                 maintenance_interval=30, prewarm_after_fork=False, *args, **kwargs):
         """初始化数据库连接参数。
         :param host: 数据库主机。
         :param schema: 数据库。
@@ -176,8 +283,14 @@ class Pool(object):
         :param pool_size: 连接池大小。
         :param extras: 允许超出连接池大小。
         :param wait_time: 从连接池获取 Engine 对象超时时间。
+        :param min_idle: 后台维护线程保持的最少空闲连接数。
+        :param max_idle_time: 空闲超过该秒数的连接将被关闭（保留 min_idle 个），应小于服务器的 wait_timeout。
+        :param max_lifetime: 连接建立超过该秒数后由后台维护线程重建。
+        :param prewarm: 初始化时并行建立连接，数量为 min_idle，未设置时为 pool_size。
+        :param maintenance_interval: 后台维护的间隔秒数，同时也是空闲连接 ping 的间隔。
+        :param prewarm_after_fork: 在子进程中重置连接池后按 prewarm 的数量重新建立连接。
         :param args: 其他参数。
-        :param kwargs: 其他参数。
+        :param kwargs: 其他参数，原样传给 Engine，例如 query_timeout 为整个连接池默认的语句超时毫秒数。
         """
         self.host = host
         self.schema = schema
@@ -197,104 +310,1484 @@ class Pool(object):
         self.pool_size = pool_size
         self.limits = extras + self.pool_size
         self._count = 0
-        self.pool = Queue(self.pool_size)
+        self.pool = []      # idle engines, the most recently used one on top
+        self._waiters = deque()
+        self.min_idle = min_idle
+        self.max_idle_time = max_idle_time
+        self.max_lifetime = max_lifetime
+        self.maintenance_interval = maintenance_interval
+        self.prewarm_after_fork = prewarm_after_fork
+        self._pid = os.getpid()
+        self._stopped = Event()
+        self._maintenance = None
+        if prewarm:
+            self._fill(min_idle or pool_size)
+        self._start_maintenance()
+
+    def _start_maintenance(self):
+        if self.min_idle or self.max_idle_time or self.max_lifetime:
+            self._maintenance = Thread(target=_maintain_pool, args=(weakref.ref(self), self._stopped))
+            self._maintenance.daemon = True
+            self._maintenance.start()
+
+    def after_fork(self):
+        """
+        在 fork 出的子进程中重置连接池：丢弃从父进程继承的连接（不关闭，其文件描述符先指向 /dev/null），
+        重建锁、空闲列表与等待队列，重启后台维护线程，设置了 prewarm_after_fork 时重新建立连接。
+        get(), put() 检测到进程号变化时会自动调用；也可以在 gunicorn 的 post_fork 等钩子中提前调用。
+        在创建连接池的进程中调用没有效果。驱动没有 Connection.fileno() 时抛出 RuntimeError，连接池保持不变。
+        """
+        with _fork_lock:
+            if self._pid == os.getpid():
+                return
+            # check before the reset, a dropped engine would send COM_QUIT when freed
+            for engine in self.pool:
+                _check_detachable(engine.connection)
+            engines = self.pool
+            # the inherited lock may have been held by a thread that does not exist here
+            self.lock = RLock()
+            self.pool, self._waiters, self._count = [], deque(), 0
+            self._stopped, self._maintenance = Event(), None
+            self._pid = os.getpid()
+        for engine in engines:
+            engine.close()
+        if self.prewarm_after_fork:
+            self._fill(self.min_idle or self.pool_size)
+        self._start_maintenance()
 
     @property
     def count(self):
         return self._count
 
+    def stats(self):
+        """返回连接池状态：Engine 总数、空闲数、借出数与等待的线程数。"""
+        if self._pid != os.getpid():
+            self.after_fork()
+        with self.lock:
+            return self._stats()
+
+    def _stats(self):
+        # caller holds self.lock
+        idle = len(self.pool)
+        return {'count': self._count, 'idle': idle, 'in_use': self._count - idle, 'waiting': len(self._waiters)}
+
+    def _new_engine(self):
+        if _instrumentation is not None:
+            _instrumentation.spawn(self)
+        return self._engine()
+
+    def _engine(self):
+        return Engine(
+            self.host, self.schema, self.user, self.pw, self.port, self.charset,
+            self.cursor_class, self.autocommit, self.debug, *self.args, **self.kwargs)
+
     def spawn_engine(self):
         self.lock.acquire()
         if self._count < self.limits:
             self._count += 1
-            _engine = Engine(
-                self.host, self.schema, self.user, self.pw, self.port, self.charset,
-                self.cursor_class, self.autocommit, self.debug, *self.args, **self.kwargs)
             self.lock.release()
+            _engine = self._new_engine()
         else:
             self.lock.release()
             _engine = self.get()
 
         return _engine
 
+    def transaction(self):
+        """
+        返回显式事务的上下文管理器：with pool.transaction() as tx: ...
+        代码块内当前线程通过本连接池执行的语句都使用同一个关闭了自动提交的 Engine，
+        正常结束时提交一次，抛出异常时回滚，之后恢复自动提交并归还 Engine。嵌套使用时创建保存点。
+        """
+        return _Transaction(self)
+
+    def pipeline(self):
+        """
+        返回语句管道：用 add() 加入多个会话，go() 把它们作为一个多语句数据包发送，
+        按加入顺序返回各会话 go() 的结果。
+        """
+        return _Pipeline(self)
+
+    def gather(self, queries, max_concurrency=None, timeout=None, return_exceptions=False):
+        """
+        并行执行多个会话的 go()，按输入顺序返回结果列表。
+        :param queries: 会话对象或无参数的可调用对象组成的列表。
+        :param max_concurrency: 同时执行的语句数，不超过连接池上限，默认等于连接池上限。
+        :param timeout: 每条语句开始执行后等待结果的秒数，超时记为 FutureTimeout，语句本身不会被中止。
+        :param return_exceptions: 为真时出错语句的异常放在结果列表中，否则在全部语句结束后抛出 GatherError。
+        """
+        tasks = [query.go if hasattr(query, 'go') else query for query in queries]
+        return _gather(tasks, min(max_concurrency or self.limits, self.limits), timeout, return_exceptions)
+
+    def map(self, fn, items, max_concurrency=None, timeout=None, return_exceptions=False):
+        """并行执行 fn(item)，按输入顺序返回结果列表，其他参数与 gather() 相同。"""
+        tasks = [lambda item=item: fn(item) for item in items]
+        return _gather(tasks, min(max_concurrency or self.limits, self.limits), timeout, return_exceptions)
+
     def put(self, engine=None):
+        if self._pid != os.getpid():
+            self.after_fork()
         if not isinstance(engine, Engine):
             engine = self.spawn_engine()
-        try:
-            self.pool.put(engine, False)
-        except Full:
-            self.lock.acquire()
-            self._count -= 1
-            self.lock.release()
+        elif engine._pid is not None and engine._pid != self._pid:
+            # checked out before the fork: not counted in this process
+            engine.close()
+            return
+        self._return(engine, _clock())
+
+    def _return(self, engine, last_used):
+        """把 Engine 交给等待的线程或放入空闲栈，空闲栈已满时关闭；last_used 为 None 时保留原来的最后使用时间。"""
+        with self.lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.engine = engine
+                waiter.event.set()
+                return
+            if len(self.pool) < self.pool_size:
+                if last_used is not None:
+                    engine.last_used = last_used
+                self.pool.append(engine)
+                return
+        self._discard(engine)
+
+    def _discard(self, engine):
+        """关闭 Engine 对象并释放其名额，有线程在等待时改为交付一个新的 Engine。"""
+        if _instrumentation is not None:
+            _instrumentation.close(self)
+        if engine.connection is not None:
+            engine.close()
+        spawned = False
+        with self.lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.engine = self._engine()
+                waiter.event.set()
+                spawned = True
+            else:
+                self._count -= 1
+        # hooks never run under self.lock, they may take locks of their own
+        if spawned and _instrumentation is not None:
+            _instrumentation.spawn(self)
+
+    def _fill(self, number):
+        """并行创建并连接最多 number 个 Engine 对象后放入连接池。"""
+        with self.lock:
+            number = max(min(number - len(self.pool), self.limits - self._count), 0)
+            self._count += number
+        engines = [self._new_engine() for _ in range(number)]
+        self._refresh(engines, lambda engine: engine.connect())
+
+    def _refresh(self, engines, action):
+        """在多个线程中对各 Engine 执行 action，失败的连接被关闭，完成后全部放回连接池，不改变最后使用时间。"""
+        def run(engine):
+            try:
+                action(engine)
+            except Exception as e:
+                if engine.debug:
+                    logger.exception(str(e))
+                engine.close()
+
+        threads = [Thread(target=run, args=(engine,)) for engine in engines]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for engine in engines:
+            # a ping is not a use, max_idle_time still counts from the last checkin
+            self._return(engine, None)
+
+    def _maintain(self):
+        """关闭超时的空闲连接，ping 其余空闲连接，重建超过生命周期的连接，并补足 min_idle。"""
+        now, expired, recycle, ping, keep = _clock(), [], [], [], []
+        with self.lock:
+            idle = len(self.pool)
+            for engine in self.pool:
+                if self.max_idle_time and now - engine.last_used > self.max_idle_time and idle > self.min_idle:
+                    expired.append(engine)
+                    idle -= 1
+                elif engine.connection is None:
+                    keep.append(engine)
+                elif self.max_lifetime and now - engine.connected_at > self.max_lifetime:
+                    recycle.append(engine)
+                elif now - engine.last_used >= self.maintenance_interval:
+                    ping.append(engine)
+                else:
+                    keep.append(engine)
+            self.pool[:] = keep
+        for engine in expired:
+            self._discard(engine)
+        self._refresh(recycle, _reconnect)
+        self._refresh(ping, _ping)
+        if self.min_idle:
+            self._fill(self.min_idle)
+
+    def close(self):
+        """停止后台维护线程并关闭所有空闲连接。"""
+        if self._pid != os.getpid():
+            self.after_fork()
+        self._stopped.set()
+        with self.lock:
+            engines, self.pool[:] = list(self.pool), []
+            self._count -= len(engines)
+        for engine in engines:
+            if engine.connection is not None:
+                engine.close()
+
+    def get(self, timeout=None):
+        """
+        获取 Engine 对象。优先返回最近归还的空闲 Engine；没有空闲 Engine 且未达到上限时立即创建新的 Engine；
+        否则按先来先得的顺序等待其他线程归还。
+        :param timeout: 等待超时秒数，默认为 wait_time，超时抛出 PoolTimeout。
+        """
+        if self._pid != os.getpid():
+            self.after_fork()
+        inst = _instrumentation
+        if inst is not None:
+            started = _clock()
+        engine = waiter = stats = None
+        with self.lock:
+            if self.pool:
+                engine = self.pool.pop()
+            elif self._count < self.limits:
+                self._count += 1
+            else:
+                waiter = _Waiter()
+                self._waiters.append(waiter)
+            if inst is not None:
+                stats = self._stats()
+        # hooks are called after releasing self.lock, with the stats captured under it
+        if engine is None and waiter is None:
+            engine = self._new_engine()
+        if engine is not None:
+            if inst is not None:
+                inst.checkout(self, _clock() - started, stats)
+            return engine
 
-    def get(self):
+        waiter.event.wait(self.wait_time if timeout is None else timeout)
+        with self.lock:
+            engine = waiter.engine
+            if engine is None:
+                self._waiters.remove(waiter)
+            if inst is not None:
+                stats = self._stats()
+        if engine is None:
+            if inst is not None:
+                inst.checkout_timeout(self, _clock() - started, stats)
+            raise PoolTimeout('no engine available in %s seconds' % (self.wait_time if timeout is None else timeout))
+        if inst is not None:
+            inst.checkout(self, _clock() - started, stats)
+        return engine
+
+
+def _maintain_pool(pool_ref, stopped):
+    """连接池后台维护线程，连接池被回收或关闭后退出。"""
+    while True:
+        pool = pool_ref()
+        if pool is None:
+            return
+        interval = pool.maintenance_interval
         try:
-            engine = self.pool.get(timeout=self.wait_time)
-            self.pool.task_done()
+            pool._maintain()
+        except Exception as e:
+            logger.exception(str(e))
+        del pool
+        if stopped.wait(interval) or stopped.is_set():
+            return
+
+
+def _ping(engine):
+    engine.connection.ping()
+
+
+def _reconnect(engine):
+    engine.close()
+    engine.connect()
+
+
+class RoutingPool(object):
+    """
+    读写分离的连接池组合：SELECT, COUNT 发往从库，INSERT, UPDATE, DELETE 发往主库。
+    同一线程写入后 sticky_window 秒内的读取仍发往主库；出错或复制延迟超过 max_lag 的从库暂时移出轮转。
+    """
+    READS = ('SELECT', 'COUNT')
+
+    def __init__(self, primary, replicas, balance='least_outstanding', sticky_window=1.0,
+                 retry_after=30, max_lag=None, check_interval=5):
+        """
+        :param primary: 主库 Pool 对象。
+        :param replicas: 从库 Pool 对象列表。
+        :param balance: 从库负载均衡策略，'least_outstanding' 选择未完成请求最少的从库，
+                        'latency' 按平均耗时加权选择。
+        :param sticky_window: 写入后读取仍发往主库的秒数。
+        :param retry_after: 连接断开或无法连接的从库移出轮转的秒数。
+        :param max_lag: 允许的最大复制延迟秒数，设置后由后台线程每 check_interval 秒检查一次。
+        :param check_interval: 复制延迟检查间隔秒数。
+        """
+        if balance not in ('least_outstanding', 'latency'):
+            raise ValueError('unknown balance strategy: %s' % balance)
+        self.primary = primary
+        self.replicas = [_Replica(replica) for replica in replicas]
+        self.balance = balance
+        self.sticky_window = sticky_window
+        self.retry_after = retry_after
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lock = RLock()
+        self._local = local()
+        self._stopped = Event()
+        if max_lag is not None:
+            thread = Thread(target=_check_replicas, args=(weakref.ref(self), self._stopped))
+            thread.daemon = True
+            thread.start()
+
+    def _choose(self):
+        """选择一个可用的从库，没有可用从库时返回 None。"""
+        now = _clock()
+        candidates = [replica for replica in self.replicas if replica.available(now)]
+        if not candidates:
+            return None
+        if self.balance == 'latency':
+            return min(candidates, key=lambda replica: (replica.outstanding + 1) * replica.latency)
+        return min(candidates, key=lambda replica: (replica.outstanding, replica.latency))
+
+    def get(self, action=None):
+        """按语句类型获取 Engine 对象。"""
+        replica = None
+        if action in self.READS and _clock() - getattr(self._local, 'written', -self.sticky_window) >= self.sticky_window:
+            with self.lock:
+                replica = self._choose()
+                if replica is not None:
+                    replica.outstanding += 1
+        if replica is None:
+            engine = self.primary.get()
+            engine._route = (None, action, _clock())
             return engine
-        except Empty:
-            self.lock.acquire()
-            if self._count < self.limits:
-                self.lock.release()
-                return self.spawn_engine()
+        try:
+            engine = replica.pool.get()
+        except Exception as e:
+            with self.lock:
+                replica.outstanding -= 1
+                # a PoolTimeout only means the replica is busy
+                if _unreachable(e):
+                    replica.down_until = _clock() + self.retry_after
+            raise
+        engine._route = (replica, action, _clock())
+        return engine
+
+    def put(self, engine, failed=False):
+        """
+        归还 Engine 对象，failed 为该 Engine 上语句执行失败时的异常。
+        只有连接断开或无法连接时从库才移出轮转，SQL 错误与超时不影响从库状态。
+        """
+        replica, action, started = engine._route
+        del engine._route
+        if replica is None:
+            if action not in self.READS:
+                self._local.written = _clock()
+            return self.primary.put(engine)
+        with self.lock:
+            replica.outstanding -= 1
+            if failed:
+                if _unreachable(failed):
+                    replica.down_until = _clock() + self.retry_after
+            else:
+                replica.observe(_clock() - started)
+        replica.pool.put(engine)
+
+    def transaction(self):
+        """在主库上开始显式事务，见 Pool.transaction()。"""
+        return _Transaction(self)
+
+    def pipeline(self):
+        """返回语句管道，全部为 SELECT, COUNT 时发往从库，否则发往主库，见 Pool.pipeline()。"""
+        return _Pipeline(self)
+
+    def check(self):
+        """检查各从库的复制延迟，延迟超过 max_lag 或复制中断的从库移出轮转。"""
+        for replica in self.replicas:
+            engine = replica.pool.get()
+            try:
+                status = engine._transaction('SHOW SLAVE STATUS', True, 'dict')
+                lag = status[0]['Seconds_Behind_Master'] if status else None
+            except Exception as e:
+                if engine.debug:
+                    logger.exception(str(e))
+                lag = None
+            finally:
+                replica.pool.put(engine)
+            with self.lock:
+                replica.lagging = lag is None or lag > self.max_lag
+
+    def close(self):
+        """停止后台检查线程并关闭所有连接池。"""
+        self._stopped.set()
+        self.primary.close()
+        for replica in self.replicas:
+            replica.pool.close()
+
+
+class _Replica(object):
+    """从库的路由状态。"""
+    DECAY = 0.2     # weight of the newest sample in the moving average latency
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.outstanding = 0
+        self.latency = 0.001
+        self.down_until = 0
+        self.lagging = False
+
+    def available(self, now):
+        return not self.lagging and now >= self.down_until
+
+    def observe(self, elapsed):
+        self.latency += (elapsed - self.latency) * self.DECAY
+
+
+def _check_replicas(routing_ref, stopped):
+    """从库延迟检查线程，RoutingPool 被回收或关闭后退出。"""
+    while True:
+        routing = routing_ref()
+        if routing is None:
+            return
+        interval = routing.check_interval
+        try:
+            routing.check()
+        except Exception as e:
+            logger.exception(str(e))
+        del routing
+        if stopped.wait(interval) or stopped.is_set():
+            return
+
+
+_transactions = local()
+
+
+def _bound_transaction(source):
+    """返回当前线程绑定在 Engine, Pool 或 RoutingPool 上的事务，没有时返回 None。"""
+    bound = getattr(_transactions, 'bound', None)
+    return bound.get(source) if bound else None
+
+
+def _checkout(source, action=None):
+    """从 Engine, Pool 或 RoutingPool 获取执行语句的 Engine 对象，当前线程在事务中时返回事务的 Engine。"""
+    transaction = _bound_transaction(source)
+    if transaction is not None:
+        return transaction.engine
+    if isinstance(source, RoutingPool):
+        return source.get(action)
+    return source.get() if isinstance(source, Pool) else source
+
+
+def _checkin(source, engine, failed=False):
+    """归还 Engine 对象，事务中的 Engine 在事务结束时归还。"""
+    if engine._tx is not None:
+        return
+    if isinstance(source, RoutingPool):
+        source.put(engine, failed)
+    elif isinstance(source, Pool):
+        source.put(engine)
+
+
+class _Transaction(object):
+    """显式事务，进入时取出一个 Engine 并绑定到当前线程，退出时提交或回滚一次。"""
+
+    def __init__(self, source):
+        self.source = source
+        self.engine = None
+        self._outer = self._savepoint = None
+        self._savepoints = 0
+        self.written = set()
+
+    def __enter__(self):
+        outer = _bound_transaction(self.source)
+        if outer is not None:
+            # nested block: run it inside a savepoint of the outer transaction
+            self._outer, self.engine = outer, outer.engine
+            self._savepoint = outer.savepoint()
+            return self
+        self.engine = _checkout(self.source, 'INSERT')
+        try:
+            self.engine.connect().autocommit(False)
+        except Exception as e:
+            self.engine.close()
+            _checkin(self.source, self.engine, e)
+            raise
+        self.engine._tx = self
+        if getattr(_transactions, 'bound', None) is None:
+            _transactions.bound = {}
+        _transactions.bound[self.source] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._outer is not None:
+            return self._savepoint.__exit__(exc_type, exc_value, tb)
+        del _transactions.bound[self.source]
+        self.engine._tx = None
+        failed = False
+        try:
+            if exc_type is None:
+                self.engine.connection.commit()
+            else:
+                self.engine.connection.rollback()
+            self.engine.connection.autocommit(self.engine.autocommit)
+        except Exception as e:
+            # the session state is unknown, never hand this connection out again
+            failed = e
+            self.engine.close()
+            if exc_type is None:
+                raise
+            if self.engine.debug:
+                logger.exception(str(e))
+        finally:
+            _checkin(self.source, self.engine, failed)
+            if _caches and not failed and exc_type is None:
+                # other threads may have cached the pre-commit rows since the writes invalidated them
+                for table_name in self.written:
+                    _invalidate(table_name)
+        return False
+
+    def execute(self, sql):
+        """在事务的 Engine 上执行一条不带参数的语句，返回影响行数。"""
+        cursor = self.engine.connection.cursor(cursors.Cursor)
+        try:
+            return cursor.execute(sql)
+        finally:
+            cursor.close()
+
+    def savepoint(self, name=None):
+        """
+        创建保存点，返回 _Savepoint 对象，也可以用作上下文管理器，代码块抛出异常时回滚到保存点。
+        :param name: 保存点名称，默认自动生成。
+        """
+        root = self._outer or self
+        if name is None:
+            root._savepoints += 1
+            name = 'sp_%d' % root._savepoints
+        return _Savepoint(root, name)
+
+
+class _Savepoint(object):
+    """事务中的保存点。"""
+
+    def __init__(self, transaction, name):
+        self.transaction, self.name = transaction, name
+        transaction.execute('SAVEPOINT `%s`' % name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.release()
+        else:
+            self.rollback()
+        return False
+
+    def rollback(self):
+        """回滚到保存点，保存点仍然有效。"""
+        self.transaction.execute('ROLLBACK TO SAVEPOINT `%s`' % self.name)
+
+    def release(self):
+        """释放保存点。"""
+        self.transaction.execute('RELEASE SAVEPOINT `%s`' % self.name)
+
+
+def _gather(tasks, workers, timeout, return_exceptions):
+    """在最多 workers 个线程中执行 tasks，按输入顺序返回结果，参数含义见 Pool.gather()。"""
+    if not tasks:
+        return []
+    executor = _Executor(min(workers, len(tasks)), len(tasks))
+    condition = Condition()
+    started = [None] * len(tasks)
+
+    def run(index, task):
+        with condition:
+            started[index] = _clock()
+            condition.notify()
+        return task()
+
+    def notify(future):
+        with condition:
+            condition.notify()
+
+    futures = [executor.submit(run, index, task) for index, task in enumerate(tasks)]
+    executor.shutdown()
+    for future in futures:
+        future.add_done_callback(notify)
+
+    results, errors = [None] * len(tasks), {}
+    pending = set(range(len(tasks)))
+    with condition:
+        while pending:
+            now = _clock()
+            deadlines = []
+            for index in list(pending):
+                future = futures[index]
+                if future.done():
+                    pending.discard(index)
+                    if future.exception() is None:
+                        results[index] = future.result()
+                    else:
+                        errors[index] = future.exception()
+                elif timeout is not None and started[index] is not None:
+                    if now - started[index] >= timeout:
+                        # the statement keeps running, its Engine returns to the pool when it ends
+                        pending.discard(index)
+                        errors[index] = FutureTimeout('query %d timed out after %ss' % (index, timeout))
+                    else:
+                        deadlines.append(started[index] + timeout)
+            if pending:
+                condition.wait(min(deadlines) - now if deadlines else None)
+
+    if return_exceptions:
+        for index, error in errors.items():
+            results[index] = error
+    elif errors:
+        raise GatherError(results, errors)
+    return results
+
+
+class PoolTimeout(Exception):
+    """在等待时间内未能从连接池获取 Engine 对象。"""
+
+
+class QueryTimeout(MySQLdb.OperationalError):
+    """语句执行超过 timeout() 或 query_timeout 设置的毫秒数，已被服务器中止，不会重试。"""
+
+
+# errors after which the statement never reached the server or the connection is gone
+_CONNECTION_LOST = (2006, 2013, 2055)
+# ER_QUERY_TIMEOUT from MAX_EXECUTION_TIME and ER_QUERY_INTERRUPTED from KILL QUERY
+_QUERY_TIMEOUT = (3024, 1317)
+
+
+def _connection_lost(error):
+    """判断异常是否为连接断开，只有这类错误才会重新连接并重试。"""
+    if isinstance(error, QueryTimeout):
+        return False
+    if isinstance(error, MySQLdb.InterfaceError):
+        return True
+    return isinstance(error, MySQLdb.OperationalError) and bool(error.args) and error.args[0] in _CONNECTION_LOST
+
+
+def _unreachable(error):
+    """判断异常是否表示服务器不可用：连接断开，或无法建立连接（2002, 2003）。"""
+    if _connection_lost(error):
+        return True
+    return (isinstance(error, MySQLdb.OperationalError) and not isinstance(error, QueryTimeout)
+            and bool(error.args) and error.args[0] in (2002, 2003))
+
+
+class _Deadline(object):
+    __slots__ = ('at', 'seq', 'engine', 'thread_id', 'state')
+
+    def __init__(self, at, seq, engine, thread_id):
+        self.at, self.seq, self.engine, self.thread_id, self.state = at, seq, engine, thread_id, 'waiting'
+
+    def __lt__(self, other):
+        return (self.at, self.seq) < (other.at, other.seq)
+
+
+class _Watchdog(object):
+    """为非 SELECT 语句计时，到期后从另一个连接发送 KILL QUERY。所有语句共用一个后台线程。"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._condition = Condition()
+        self._heap = []
+        self._sequence = count()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def watch(self, engine, seconds):
+        if self._pid != os.getpid():
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        deadline = _Deadline(_clock() + seconds, next(self._sequence), engine, engine.connection.thread_id())
+        with self._condition:
+            heappush(self._heap, deadline)
+            if self._thread is None:
+                self._thread = Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return deadline
+
+    def cancel(self, deadline):
+        """取消计时，返回 KILL QUERY 是否已发送；正在发送时等待其完成，避免误杀连接上的下一条语句。"""
+        with self._condition:
+            while deadline.state == 'killing':
+                self._condition.wait()
+            killed = deadline.state == 'killed'
+            deadline.state = 'cancelled'
+            return killed
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    while self._heap and self._heap[0].state == 'cancelled':
+                        heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0].at - _clock()
+                    if delay <= 0:
+                        deadline = heappop(self._heap)
+                        deadline.state = 'killing'
+                        break
+                    self._condition.wait(delay)
+            _kill_query(deadline.engine, deadline.thread_id)
+            with self._condition:
+                deadline.state = 'killed'
+                self._condition.notify_all()
+
+
+def _kill_query(engine, thread_id):
+    """新建一个连接发送 KILL QUERY，中止 thread_id 上正在执行的语句。"""
+    side = Engine(engine.host, engine.schema, engine.user, engine.pw, engine.port, engine.charset, debug=engine.debug)
+    try:
+        side._transaction('KILL QUERY %d' % thread_id)
+    except Exception as e:
+        logger.warning('failed to kill query on thread %s: %s', thread_id, e)
+    finally:
+        side.close()
+
+
+_watchdog = _Watchdog()
+
+
+class GatherError(Exception):
+    """
+    Pool.gather() 或 Pool.map() 中有语句出错，其他语句均已执行完毕。
+    results 为按输入顺序排列的结果列表，出错位置为 None；errors 为 {序号: 异常}。
+    """
+
+    def __init__(self, results, errors):
+        super(GatherError, self).__init__('%d of %d queries failed' % (len(errors), len(results)))
+        self.results, self.errors = results, errors
+
+
+class _Waiter(object):
+    """等待 Engine 对象的线程，由 Pool.put() 直接交付 Engine。"""
+
+    def __init__(self):
+        self.event = Event()
+        self.engine = None
+
+
+class Future(object):
+    """异步执行的结果，接口与 concurrent.futures.Future 相同。"""
+    PENDING, RUNNING, CANCELLED, FINISHED = 'PENDING', 'RUNNING', 'CANCELLED', 'FINISHED'
+
+    def __init__(self):
+        self._condition = Condition()
+        self._state = self.PENDING
+        self._result = self._exception = None
+        self._callbacks = []
+
+    def cancel(self):
+        """取消尚未开始执行的任务，已开始或已完成的任务无法取消。"""
+        with self._condition:
+            if self._state == self.CANCELLED:
+                return True
+            if self._state != self.PENDING:
+                return False
+            self._state = self.CANCELLED
+            self._condition.notify_all()
+        self._invoke_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == self.CANCELLED
+
+    def running(self):
+        return self._state == self.RUNNING
+
+    def done(self):
+        return self._state in (self.CANCELLED, self.FINISHED)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if timeout is None:
+                while not self.done():
+                    self._condition.wait()
+            elif not self.done():
+                self._condition.wait(timeout)
+            if self._state == self.CANCELLED:
+                raise CancelledError()
+            if self._state != self.FINISHED:
+                raise FutureTimeout()
+
+    def result(self, timeout=None):
+        """等待并返回结果，任务出错时抛出原异常。"""
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """任务完成或被取消后在执行线程中调用 fn(future)，已完成时立即调用。"""
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _start(self):
+        with self._condition:
+            if self._state != self.PENDING:
+                return False
+            self._state = self.RUNNING
+            return True
+
+    def _finish(self, result=None, exception=None):
+        with self._condition:
+            self._result, self._exception, self._state = result, exception, self.FINISHED
+            self._condition.notify_all()
+        self._invoke_callbacks()
+
+    def _invoke_callbacks(self):
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.exception(str(e))
+
+
+class CancelledError(Exception):
+    """任务已被取消。"""
+
+
+class FutureTimeout(Exception):
+    """等待任务结果超时。"""
+
+
+class _Executor(object):
+    """固定数量工作线程的执行器，任务队列有界，队列满时 submit() 阻塞以提供背压。"""
+
+    def __init__(self, workers, backlog):
+        self.workers = workers
+        self._tasks = Queue(backlog)
+        self._threads = []
+        self._lock = RLock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if len(self._threads) < self.workers:
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future._start():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                future._finish(exception=e)
+            else:
+                future._finish(result)
+
+    def shutdown(self):
+        """已提交的任务执行完后结束所有工作线程。"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._tasks.put(None)
+
+
+class AsyncPool(Pool):
+    """
+    带有工作线程的连接池，会话对象的 go_async(), iter_async() 在工作线程中执行并立即返回 Future。
+    工作线程数等于连接池上限 pool_size + extras，同时执行的语句不超过可用连接数。
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        参数与 Pool 相同，另外支持：
+        :param backlog: 等待执行的任务数上限，超过后 submit() 阻塞，默认为工作线程数的 4 倍。
+        """
+        backlog = kwargs.pop('backlog', None)
+        super(AsyncPool, self).__init__(*args, **kwargs)
+        self.executor = _Executor(self.limits, backlog or self.limits * 4)
+
+    def submit(self, fn, *args, **kwargs):
+        """在工作线程中执行 fn(*args, **kwargs)，返回 Future。"""
+        if self._pid != os.getpid():
+            self.after_fork()
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def after_fork(self):
+        """在子进程中重置连接池，并以新的工作线程替换父进程的执行器，父进程中排队的任务被丢弃。"""
+        forked = self._pid != os.getpid()
+        super(AsyncPool, self).after_fork()
+        if forked:
+            self.executor = _Executor(self.executor.workers, self.executor._tasks.maxsize)
+
+    def close(self):
+        self.executor.shutdown()
+        super(AsyncPool, self).close()
+
+
+class Instrumentation(object):
+    """
+    度量钩子的基类，所有方法均为空操作，子类覆写需要的方法后通过 set_instrumentation() 安装。
+    耗时以秒为单位，使用单调时钟（Python 2 下退化为 time.time）计量。
+    """
+
+    def checkout(self, pool, wait, stats):
+        """从 Pool 借出 Engine，wait 为等待时间，stats 为借出时的 Pool.stats()。钩子中不要再调用 Pool 的方法。"""
+
+    def checkout_timeout(self, pool, wait, stats):
+        """等待 Engine 超时。"""
+
+    def spawn(self, pool):
+        """Pool 创建了新的 Engine。"""
+
+    def close(self, pool):
+        """Pool 关闭并丢弃了一个 Engine。"""
+
+    def execute(self, shape, elapsed):
+        """执行了一条语句，shape 为不含参数值的语句模板。"""
+
+    def fetch(self, shape, elapsed, rows):
+        """读取了语句的结果集。"""
+
+
+class Histogram(object):
+    """按对数分桶的耗时直方图，每个桶的上界为前一个桶的 2 ** 0.25 倍，误差不超过 19%。"""
+    FLOOR, FACTOR, SIZE = 1e-6, 2 ** 0.25, 128
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count, self.total, self.max = 0, 0.0, 0.0
+
+    def record(self, value):
+        index = int(math.log(value / self.FLOOR, self.FACTOR)) + 1 if value > self.FLOOR else 0
+        self.counts[min(index, self.SIZE - 1)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """返回第 percent 百分位数所在桶的上界。"""
+        if not self.count:
+            return None
+        rank, seen = self.count * percent / 100.0, 0
+        for index, number in enumerate(self.counts):
+            seen += number
+            if number and seen >= rank:
+                return min(self.FLOOR * self.FACTOR ** index, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+class MemoryInstrumentation(Instrumentation):
+    """在内存中记录计数器、借出等待时间与各语句模板的执行、读取耗时直方图，用于测试或自行导出。"""
+
+    def __init__(self):
+        self.lock = RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {'checkouts': 0, 'timeouts': 0, 'spawns': 0, 'closes': 0}
+            self.checkout_wait = Histogram()
+            self.pools = {}
+            self.statements = {}
+
+    def _statement(self, shape):
+        try:
+            return self.statements[shape]
+        except KeyError:
+            return self.statements.setdefault(shape, {'execute': Histogram(), 'fetch': Histogram(), 'rows': 0})
+
+    def checkout(self, pool, wait, stats):
+        with self.lock:
+            self.counters['checkouts'] += 1
+            self.checkout_wait.record(wait)
+            self.pools[id(pool)] = stats
+
+    def checkout_timeout(self, pool, wait, stats):
+        with self.lock:
+            self.counters['timeouts'] += 1
+            self.pools[id(pool)] = stats
+
+    def spawn(self, pool):
+        with self.lock:
+            self.counters['spawns'] += 1
+
+    def close(self, pool):
+        with self.lock:
+            self.counters['closes'] += 1
+
+    def execute(self, shape, elapsed):
+        with self.lock:
+            self._statement(shape)['execute'].record(elapsed)
+
+    def fetch(self, shape, elapsed, rows):
+        with self.lock:
+            statement = self._statement(shape)
+            statement['fetch'].record(elapsed)
+            statement['rows'] += rows
+
+    def snapshot(self):
+        """返回当前度量数据的副本。"""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'checkout_wait': self.checkout_wait.snapshot(),
+                'pools': dict(self.pools),
+                'statements': dict((shape, {'execute': value['execute'].snapshot(),
+                                            'fetch': value['fetch'].snapshot(),
+                                            'rows': value['rows']})
+                                   for shape, value in self.statements.items())}
+
+
+_instrumentation = None
+
+
+def set_instrumentation(instrumentation=None):
+    """安装度量钩子，传入 None 关闭度量。"""
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+_IN_LIST = re.compile(r' IN \((?:%\(\w+\)s,?)+\)')
+
+
+def _shape(sql):
+    """语句模板：IN 列表折叠为 (...)，使不同长度的 IN 列表归为同一模板。"""
+    shape = _shapes.get(sql)
+    if shape is None:
+        shape = _shapes.set(sql, _IN_LIST.sub(' IN (...)', sql))
+    return shape
+
+
+def _timestamp():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class _LRUCache(object):
+    """线程安全的 LRU 缓存，记录命中与未命中次数。"""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """返回 {'hits': 命中次数, 'misses': 未命中次数, 'size': 当前条目数, 'maxsize': 最大条目数}。"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class ResultCache(object):
+    """
+    SELECT, COUNT 结果缓存，按最终 SQL 文本与参数索引，条目按 TTL 过期并按 LRU 淘汰。
+    同一数据表经由本模块执行的 INSERT, UPDATE, DELETE 会使该表的所有条目失效。
+    同一个键的并发未命中只执行一次查询，其他线程等待该查询的结果。
+    缓存的结果由所有调用者共享，不要修改。
+    """
+
+    def __init__(self, max_entries=1024, max_rows=None, max_bytes=None, ttl=60, on_invalidate=None):
+        """
+        :param max_entries: 最多缓存的条目数。
+        :param max_rows: 所有条目的总行数上限。
+        :param max_bytes: 所有条目的估算字节数上限，按结果的 repr() 长度估算。
+        :param ttl: 默认的过期秒数。
+        :param on_invalidate: 数据表失效时的回调 on_invalidate(table_name)，用于通知其他进程，
+                              其他进程收到通知后调用 invalidate(table_name, propagate=False)。
+        """
+        self.max_entries, self.max_rows, self.max_bytes = max_entries, max_rows, max_bytes
+        self.ttl = ttl
+        self.on_invalidate = on_invalidate
+        self.hits = self.misses = 0
+        self.rows = self.bytes = 0
+        self._entries = OrderedDict()   # key -> (expires, table_name, result, rows, size)
+        self._tables = {}               # table_name -> set of keys
+        self._loading = {}              # key -> _Load
+        self._generations = {}          # table_name -> number of invalidations
+        self._lock = RLock()
+        _caches[id(self)] = self
+
+    def get(self, key, table_name, loader, ttl=None):
+        """返回缓存的结果，未命中或已过期时调用 loader() 查询并缓存。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > _clock():
+                del self._entries[key]
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            load = self._loading.get(key)
+            if load is None:
+                load = self._loading[key] = _Load(self._generations.get(table_name, 0))
+                leader = True
             else:
-                self.lock.release()
-                engine = self.pool.get()
-                self.pool.task_done()
-                return engine
+                leader = False
+        if not leader:
+            return load.wait()
+
+        try:
+            result = loader()
+        except Exception as e:
+            with self._lock:
+                del self._loading[key]
+            load.done(exception=e)
+            raise
+        with self._lock:
+            del self._loading[key]
+            if load.generation == self._generations.get(table_name, 0):
+                self._store(key, table_name, result, self.ttl if ttl is None else ttl)
+        load.done(result)
+        return result
+
+    def _store(self, key, table_name, result, ttl):
+        rows = len(result) if isinstance(result, (list, tuple)) else 1
+        size = len(repr(result)) if self.max_bytes else 0
+        self._remove(key)
+        self._entries[key] = (_clock() + ttl, table_name, result, rows, size)
+        self._tables.setdefault(table_name, set()).add(key)
+        self.rows += rows
+        self.bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 (self.max_rows and self.rows > self.max_rows) or
+                                 (self.max_bytes and self.bytes > self.max_bytes)):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._tables[entry[1]].discard(key)
+            self.rows -= entry[3]
+            self.bytes -= entry[4]
+
+    def invalidate(self, table_name, propagate=True):
+        """使数据表的所有条目失效，propagate 为真时调用 on_invalidate 回调。"""
+        with self._lock:
+            self._generations[table_name] = self._generations.get(table_name, 0) + 1
+            for key in list(self._tables.get(table_name, ())):
+                self._remove(key)
+        if propagate and self.on_invalidate is not None:
+            self.on_invalidate(table_name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tables.clear()
+            self.rows = self.bytes = 0
+
+    def info(self):
+        """返回命中次数、未命中次数、条目数、总行数与估算字节数。"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                'rows': self.rows, 'bytes': self.bytes}
+
+
+class _Load(object):
+    """正在进行的一次缓存查询，并发未命中的线程等待其结果。"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.event = Event()
+        self.result = self.exception = None
+
+    def done(self, result=None, exception=None):
+        self.result, self.exception = result, exception
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+_caches = weakref.WeakValueDictionary()
+default_cache = None    # used by cached() without a cache, created on first use
+
+
+def _default_cache():
+    global default_cache
+    if default_cache is None:
+        default_cache = ResultCache()
+    return default_cache
+
+
+def _invalidate(table_name):
+    """写操作之后使所有 ResultCache 中该数据表的条目失效。"""
+    for cache in list(_caches.values()):
+        cache.invalidate(table_name)
+
+
+class Record(tuple):
+    """
+    紧凑的行记录，按结果的字段列表生成子类并缓存。
+    支持下标、字段名（record['name']）与属性（record.name）访问，与 tuple 方法同名或不是合法标识符的字段只能按字段名访问。
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        return list(self._fields)
+
+    def as_dict(self):
+        return dict(zip(self._fields, self))
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join(['%s=%r' % item for item in zip(self._fields, self)])
+
+
+class ColumnarResult(dict):
+    """按列组织的查询结果：字段名称 -> 列数据，masks 属性保存含 NULL 的列的掩码（真值表示 NULL）。"""
+
+    def __init__(self, columns=(), masks=None, rows=0):
+        super(ColumnarResult, self).__init__(columns)
+        self.masks = masks or {}
+        self.rows = rows
+
+
+_INTEGER_TYPES = (FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.LONG, FIELD_TYPE.INT24, FIELD_TYPE.LONGLONG,
+                  FIELD_TYPE.YEAR)
+# DECIMAL stays an object column, a float64 would lose its exact value
+_FLOAT_TYPES = (FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE)
+
+
+class _Columns(object):
+    """
+    逐批把 tuple 行追加到各列的缓冲区中，整数与浮点数列直接写入 array.array。
+    整数超出 C long 的范围时（如 BIGINT UNSIGNED 大于 2**63 - 1 的值），该列改为对象列。
+    """
+
+    def __init__(self, description):
+        self.names = [d[0] for d in description]
+        self.kinds = [_column_kind(d[1]) for d in description]
+        self.data = [array(kind) if kind else [] for kind in self.kinds]
+        self.masks = [None] * len(self.names)
+        self.rows = 0
+
+    def add(self, rows):
+        if not rows:
+            return
+        for index, values in enumerate(zip(*rows)):
+            mask, nulls = self.masks[index], None in values
+            if nulls:
+                if mask is None:
+                    mask = self.masks[index] = array('b', [0]) * self.rows
+                mask.extend([value is None for value in values])
+            elif mask is not None:
+                mask.extend(array('b', [0]) * len(values))
+            data = self.data[index]
+            if self.kinds[index]:
+                try:
+                    data.extend([0 if value is None else value for value in values] if nulls else values)
+                    continue
+                except OverflowError:
+                    # array.extend() keeps the items added before the failure
+                    del data[self.rows:]
+                    data = self._to_objects(index)
+            data.extend(values)
+        self.rows += len(rows)
+
+    def _to_objects(self, index):
+        """把一个 array 列改为对象列，NULL 位置恢复为 None。"""
+        values, mask = self.data[index].tolist(), self.masks[index]
+        if mask is not None:
+            values = [None if null else value for value, null in zip(values, mask)]
+        self.data[index], self.kinds[index] = values, None
+        return values
+
+    def result(self, use_numpy=True):
+        columns, masks = {}, {}
+        for name, kind, data, mask in zip(self.names, self.kinds, self.data, self.masks):
+            if use_numpy and numpy is not None:
+                if kind:
+                    data = numpy.frombuffer(data, dtype=kind) if len(data) else numpy.zeros(0, dtype=kind)
+                else:
+                    values, data = data, numpy.empty(len(data), dtype=object)
+                    data[:] = values
+                if mask is not None:
+                    mask = numpy.frombuffer(mask, dtype=numpy.bool_)
+                    data = numpy.ma.MaskedArray(data, mask=mask)
+            columns[name] = data
+            if mask is not None:
+                masks[name] = mask
+        return ColumnarResult(columns, masks, self.rows)
+
+
+def _column_kind(field_type):
+    """字段类型对应的 array.array 类型码，其他类型返回 None。"""
+    if field_type in _INTEGER_TYPES:
+        return 'l'
+    if field_type in _FLOAT_TYPES:
+        return 'd'
+    return None
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_record_classes = _LRUCache(256)
+
+
+def _record_class(fields):
+    """按字段列表生成 Record 子类。"""
+    cls = _record_classes.get(fields)
+    if cls is None:
+        namespace = {'__slots__': (), '_fields': fields, '_index': dict((f, i) for i, f in enumerate(fields))}
+        for index, field in enumerate(fields):
+            if _IDENTIFIER.match(field) and not keyword.iskeyword(field) and not hasattr(Record, field):
+                namespace[field] = property(itemgetter(index))
+        cls = _record_classes.set(fields, type('Record', (Record,), namespace))
+    return cls
+
+
+def _records(description, rows):
+    """把 tuple 行转换为 Record 对象。"""
+    cls = _record_class(tuple([d[0] for d in description or ()]))
+    new = tuple.__new__
+    return tuple([new(cls, row) for row in rows])
+
+
+# statement shapes for instrumentation, keyed by SQL text
+_shapes = _LRUCache(1024)
+
+
+class Param(object):
+    """编译语句中的参数占位符，执行时由 _Compiled.go() 的同名关键字参数替换。"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
+
+class _InList(tuple):
+    """Column.in_(), not_in() 生成的条件，记录字段与占位符名称，超长时会话可以分批执行。"""
+
+    def __new__(cls, column, values, negated):
+        names = ['{0}_in_{1}'.format(column, index) for index in range(len(values))]
+        clause = '{0} {1}IN ({2})'.format(column, 'NOT ' if negated else '', _placeholders(names))
+        self = tuple.__new__(cls, (clause, dict(zip(names, values))))
+        self.column, self.names, self.negated = column, names, negated
+        return self
+
+
+def _placeholders(names):
+    return ','.join(['%({0})s'.format(name) for name in names])
+
+
+# IN lists longer than this are run in chunks, see _BaseSession.chunk_in().
+IN_CHUNK_SIZE = 1000
+_temporary_tables = count(1)
 
 
 class Column(object):
     def __init__(self, name):
         """数据库字段。"""
         self.name = name
+        self._templates = {}
 
     def __str__(self):
         return self.name
 
+    def _compare(self, operator, symbol, other):
+        """生成比较条件，占位符与条件文本按字段缓存。"""
+        try:
+            clause, name = self._templates[operator]
+        except KeyError:
+            name = '{0}_{1}'.format(self.name, operator)
+            clause = '{0}{1}%({2})s'.format(self.name, symbol, name)
+            self._templates[operator] = clause, name
+        return clause, {name: other}
+
     def __eq__(self, other):
-        name = '{0}_{1}'.format(self.name, 'eq')
-        return '{0}=%({1})s'.format(self.name, name), {name: other}
+        return self._compare('eq', '=', other)
 
     def __ne__(self, other):
-        name = '{0}_{1}'.format(self.name, 'ne')
-        return '{0}<>%({1})s'.format(self.name, name), {name: other}
+        return self._compare('ne', '<>', other)
 
     def __gt__(self, other):
-        name = '{0}_{1}'.format(self.name, 'gt')
-        return '{0}>%({1})s'.format(self.name, name), {name: other}
+        return self._compare('gt', '>', other)
 
     def __ge__(self, other):
-        name = '{0}_{1}'.format(self.name, 'ge')
-        return '{0}>=%({1})s'.format(self.name, name), {name: other}
+        return self._compare('ge', '>=', other)
 
     def __lt__(self, other):
-        name = '{0}_{1}'.format(self.name, 'lt')
-        return '{0}<%({1})s'.format(self.name, name), {name: other}
+        return self._compare('lt', '<', other)
 
     def __le__(self, other):
-        name = '{0}_{1}'.format(self.name, 'le')
-        return '{0}<=%({1})s'.format(self.name, name), {name: other}
+        return self._compare('le', '<=', other)
 
     def like(self, other):
-        name = '{0}_{1}'.format(self.name, 'like')
-        return '{0} LIKE %({1})s'.format(self.name, name), {name: other}
+        return self._compare('like', ' LIKE ', other)
 
     def in_(self, *other):
-        names, maps = [], {}
-        for index in range(len(other)):
-            name = '{0}_{1}_{2}'.format(self.name, 'in', index)
-            names.append("%({0})s".format(name))
-            maps[name] = other[index]
-        return '{0} IN ({1})'.format(self.name, ",".join(names)), maps
+        return _InList(self.name, other, False)
 
     def not_in(self, *other):
-        names, maps = [], {}
-        for index in range(len(other)):
-            name = '{0}_{1}_{2}'.format(self.name, 'in', index)
-            names.append("%({0})s".format(name))
-            maps[name] = other[index]
-        return '{0} NOT IN ({1})'.format(self.name, ",".join(names)), maps
+        return _InList(self.name, other, True)
 
     def between(self, floor, ceil):
         _floor = '{0}_{1}'.format(self.name, 'floor')
@@ -328,6 +1821,7 @@ class Table(object):
         """初始化数据表，可以在columns参数中动态传入字段名称，或者覆写本方法并在新方法中直接定义字段。"""
         self.engine = _engine
         self.table_name = table_name
+        self.result_cache, self.cache_ttl = None, None
         self.add_column(*columns)
 
     def add_column(self, *columns):
@@ -347,9 +1841,18 @@ class Table(object):
         self.engine = engine
         return self
 
+    def enable_cache(self, cache=None, ttl=None):
+        """
+        缓存本表的 SELECT, COUNT 结果。
+        :param cache: ResultCache 对象，为 None 时关闭缓存。
+        :param ttl: 过期秒数，默认使用 cache.ttl。
+        """
+        self.result_cache, self.cache_ttl = cache, ttl
+        return self
+
     def select(self, *columns):
         """SELECT操作。"""
-        return _Select(self.engine, self.table_name, 'SELECT', *columns)
+        return _Select(self.engine, self.table_name, 'SELECT', *columns).cached(self.cache_ttl, self.result_cache)
 
     def insert(self, **assignments):
         """INSERT操作。"""
@@ -363,9 +1866,49 @@ class Table(object):
         """DELETE操作。"""
         return _Delete(self.engine, self.table_name, 'DELETE')
 
-    def count(self, column=None, distinct=None):
-        """COUNT操作。"""
-        return _Count(self.engine, self.table_name, 'COUNT', column, distinct)
+    def count(self, column=None, distinct=None, approximate=False, exact_below=None, max_staleness=None):
+        """
+        COUNT操作。
+        :param approximate: 为真时返回估算的行数，见 _Count.approximate()。
+        :param exact_below: 估算值小于该值时改为精确计数。
+        :param max_staleness: 可以接受的结果过期秒数，设置后结果缓存该秒数。
+        """
+        session = _Count(self.engine, self.table_name, 'COUNT', column, distinct).cached(self.cache_ttl, self.result_cache)
+        if approximate:
+            session.approximate(exact_below=exact_below)
+        if max_staleness is not None:
+            session.cached(max_staleness, self.result_cache)
+        return session
+
+    def insert_many(self, rows, columns=None, max_rows=1000, max_packet=None):
+        """批量INSERT操作。"""
+        return _InsertMany(self.engine, self.table_name, 'INSERT', rows, columns, max_rows, max_packet)
+
+    def upsert_many(self, rows, key=None, update=None, columns=None, max_rows=1000, max_packet=None):
+        """批量 INSERT ... ON DUPLICATE KEY UPDATE 操作。"""
+        return _UpsertMany(self.engine, self.table_name, 'INSERT', rows, key, update, columns, max_rows, max_packet)
+
+    def update_many(self, rows, key, columns=None, max_rows=1000, max_packet=None):
+        """按行更新不同值的批量 UPDATE 操作。"""
+        return _UpdateMany(self.engine, self.table_name, 'UPDATE', rows, key, columns, max_rows, max_packet)
+
+    def load_from(self, source, columns=None, format='csv', ignore_lines=0):
+        """使用 LOAD DATA LOCAL INFILE 批量导入，参数见 _LoadData。"""
+        return _LoadData(self.engine, self.table_name, 'LOAD', source, columns, format, ignore_lines)
+
+    def buffered_writer(self, max_rows=1000, max_delay_ms=100, max_queue=None, on_error=None):
+        """
+        返回缓冲写入器：insert(**row) 只把行放入队列，由后台线程合并为多行 INSERT 写入。
+        :param max_rows: 每批最多写入的行数，达到后立即写入。
+        :param max_delay_ms: 一行在队列中最多停留的毫秒数，到期后写入当前批次。
+        :param max_queue: 队列容量，队列满时 insert() 阻塞，默认为 max_rows 的 10 倍。
+        :param on_error: 写入失败时调用 on_error(exception, rows)，默认记录日志。
+        """
+        return _BufferedWriter(self, max_rows, max_delay_ms, max_queue, on_error)
+
+    def scan(self, key, batch_size=1000, where=None, columns=None, start=None, slices=None):
+        """按主键分页遍历数据表（keyset pagination），返回可迭代的 _Scan 对象。"""
+        return _Scan(self, key, batch_size, where, columns, start, slices)
 
 
 class _BaseSession(object):
@@ -376,10 +1919,48 @@ class _BaseSession(object):
         self._where_clause, self._where_dict = '', {}
         self._distinct_clause = self._order_clause = self._limit_clause = ''
         self.affected_rows, self.last_executed = 0, ''
+        self._cache, self._cache_ttl = None, None
+        self._in_lists, self._in_disjunctive = [], False
+        self._in_chunk = (None, False, False)
+        self._timeout = None
         self.limit(1)   # for safety consideration
 
+    def timeout(self, ms):
+        """
+        设置本语句的超时毫秒数，覆盖 Engine/Pool 的 query_timeout，None 或 0 表示不限制。
+        SELECT 通过 MAX_EXECUTION_TIME 提示由服务器中止，其他语句到期后从另一个连接发送 KILL QUERY；
+        超时抛出 QueryTimeout，不会重试。
+        :param ms: 毫秒数。
+        """
+        self._timeout = ms
+        return self
+
+    def chunk_in(self, size=None, parallel=False, temporary=False):
+        """
+        设置超长 IN 列表的执行方式，对 SELECT, UPDATE, DELETE 的 go() 有效。
+        默认把超过 size 个值的 IN 列表分成多条语句依次执行，再连接结果或累加影响行数；
+        仅当条件之间全为 AND 且没有 LIMIT, ORDER BY, DISTINCT, GROUP BY 时分批，否则仍作为一条语句执行。
+        :param size: 每批的值数量，默认为 IN_CHUNK_SIZE。
+        :param parallel: 为真且绑定的是 Pool 时，通过 Pool.gather() 并行执行各批。
+        :param temporary: 为真时改为把值写入临时表，用 IN (SELECT ...) 执行一条语句，同样适用于 NOT IN 与 COUNT。
+        """
+        self._in_chunk = (size, parallel, temporary)
+        return self
+
+    def cached(self, ttl=None, cache=None):
+        """
+        缓存本语句的结果，仅对 SELECT, COUNT 有效。
+        :param ttl: 过期秒数，默认使用 cache.ttl。
+        :param cache: ResultCache 对象，默认使用模块级的 default_cache。
+        """
+        if cache is None and ttl is not None:
+            cache = _default_cache()
+        self._cache, self._cache_ttl = cache, ttl
+        return self
+
     def clear(self):
         self._where_clause, self._where_dict = '', {}
+        self._in_lists, self._in_disjunctive = [], False
         self._distinct_clause = self._order_clause = self._limit_clause = ''
         self.limit(1)   # for safety consideration
         return self
@@ -395,6 +1976,7 @@ class _BaseSession(object):
         :param columns: Column对象。
         """
         if columns:
+            self._track_in(columns, bool(self._where_clause))
             if self._where_clause:
                 new_clause = '({0})'.format(' AND '.join([col[0] for col in columns]))
                 self._where_clause = ' OR '.join([self._where_clause, new_clause])
@@ -403,10 +1985,12 @@ class _BaseSession(object):
             self._where_dict.update(reduce(lambda x, y: x + y, [column[1].items() for column in columns]))
         else:
             self._where_clause, self._where_dict = '', {}
+            self._in_lists, self._in_disjunctive = [], False
         return self
 
     def where_and(self, *columns):
         if columns:
+            self._track_in(columns, False)
             if self._where_clause:
                 new_clause = '({0})'.format(' AND '.join([col[0] for col in columns]))
                 self._where_clause = ' AND '.join([self._where_clause, new_clause])
@@ -415,8 +1999,13 @@ class _BaseSession(object):
             self._where_dict.update(reduce(lambda x, y: x + y, [column[1].items() for column in columns]))
         else:
             self._where_clause, self._where_dict = '', {}
+            self._in_lists, self._in_disjunctive = [], False
         return self
 
+    def _track_in(self, columns, disjunctive):
+        self._in_lists.extend([column for column in columns if isinstance(column, _InList)])
+        self._in_disjunctive = self._in_disjunctive or disjunctive
+
     def order(self, column=None, desc=False):
         """执行ORDER条件。"""
         self._order_clause = ('ORDER BY {0} {1}'.format(str(column), 'DESC' if desc else 'ASC')) if column else ''
@@ -429,40 +2018,212 @@ class _BaseSession(object):
             self._limit_clause = '%s, %s' % (self._limit_clause, step)
         return self
 
-    def _transaction(self, clauses, sql_dict, cursor_class):
-        sql_clause = ' '.join([clause for clause in clauses if clause])
-        self.affected_rows, self.last_executed, timestamp = 0, '', datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    def _checkout(self):
+        """获取执行语句的 Engine 对象。"""
+        return _checkout(self.engine, self.action)
 
-        _engine = self.engine.get() if isinstance(self.engine, Pool) else self.engine
+    def _checkin(self, _engine, failed=False):
+        """归还 Engine 对象，failed 为执行失败时的异常。"""
+        _checkin(self.engine, _engine, failed)
 
+    def _execute(self, _engine, sql, sql_dict, cursor_class, streaming=False, shape=None):
+        """在指定 Engine 上执行SQL语句，连接断开时重新连接并重试一次，返回游标。"""
+        self.affected_rows, self.last_executed = 0, ''
+        timestamp = _timestamp() if _engine.debug and logger.isEnabledFor(logging.DEBUG) else None
+        inst = _instrumentation
+        if inst is not None:
+            started = _clock()
+        timeout = self._timeout if self._timeout is not None else _engine.query_timeout
         try:
-            conn = _engine.connect(cursor_class)
+            conn = _engine.connect(cursor_class, streaming)
             cursor = conn.cursor()
-            self.affected_rows = cursor.execute(sql_clause, sql_dict)
+            self.affected_rows = self._timed(_engine, cursor, sql, sql_dict, timeout)
         except Exception as e:
             if _engine.debug:
                 logger.exception(str(e))
+            if _engine._tx is not None or not _connection_lost(e):
+                # reconnecting would silently drop the open transaction, and
+                # re-running a timed out or failing statement only adds load
+                raise
             _engine.close()
-            conn = _engine.connect(cursor_class)
+            conn = _engine.connect(cursor_class, streaming)
             cursor = conn.cursor()
-            self.affected_rows = cursor.execute(sql_clause, sql_dict)
-        finally:
-            if isinstance(self.engine, Pool):
-                self.engine.put(_engine)
+            self.affected_rows = self._timed(_engine, cursor, sql, sql_dict, timeout)
 
+        if inst is not None:
+            inst.execute(shape or _shape(sql), _clock() - started)
         self.last_executed = cursor._last_executed
-        if _engine.debug:
+        if timestamp is not None:
             logger.debug('%s: %s ROW(S) AFFECTED WITH SQL: %s', timestamp, self.affected_rows, self.last_executed)
+        return cursor
+
+    @staticmethod
+    def _timed(_engine, cursor, sql, sql_dict, timeout):
+        """执行语句，timeout 毫秒后由服务器中止，超时抛出 QueryTimeout。"""
+        if not timeout:
+            return cursor.execute(sql, sql_dict)
+        deadline = None
+        if sql[:7].upper() == 'SELECT ':
+            # concatenated rather than %-formatted: sql still holds its %(name)s placeholders
+            sql = 'SELECT /*+ MAX_EXECUTION_TIME(' + str(int(timeout)) + ') */ ' + sql[7:]
+        else:
+            deadline = _watchdog.watch(_engine, timeout / 1000.0)
+        try:
+            return cursor.execute(sql, sql_dict)
+        except MySQLdb.OperationalError as e:
+            killed = deadline is not None and _watchdog.cancel(deadline)
+            code = e.args[0] if e.args else None
+            if killed or code in _QUERY_TIMEOUT:
+                raise QueryTimeout(code, 'statement exceeded %d ms: %s' % (timeout, e.args[-1] if e.args else e))
+            raise
+        finally:
+            if deadline is not None:
+                _watchdog.cancel(deadline)
+
+    def _statement(self):
+        """返回 (SQL 子句列表, 参数字典)。"""
+        raise NotImplementedError
+
+    def _executor(self):
+        if not isinstance(self.engine, AsyncPool):
+            raise TypeError('asynchronous execution requires an AsyncPool')
+        return self.engine
+
+    def go_async(self, *args, **kwargs):
+        """在 AsyncPool 的工作线程中执行 go()，立即返回 Future。"""
+        return self._executor().submit(self.go, *args, **kwargs)
+
+    def compile(self):
+        """
+        编译当前语句，返回可以反复执行的 _Compiled 对象。
+        条件或赋值中的 Param 对象在执行时由 _Compiled.go() 的同名关键字参数替换。
+        """
+        clauses, sql_dict = self._statement()
+        return _Compiled(self, ' '.join([clause for clause in clauses if clause]), sql_dict)
+
+    def _transaction(self, clauses, sql_dict, cursor_class):
+        sql_clause = ' '.join([clause for clause in clauses if clause])
+        if self._cache is not None and self.action in ('SELECT', 'COUNT') and \
+                _bound_transaction(self.engine) is None:
+            key = (sql_clause, repr(sorted(sql_dict.items())), cursor_class)
+            return self._cache.get(key, self.table_name, lambda: self._run(sql_clause, sql_dict, cursor_class),
+                                   self._cache_ttl)
+        return self._run(sql_clause, sql_dict, cursor_class)
+
+    def _run(self, sql_clause, sql_dict, cursor_class):
+        size, parallel, temporary = self._in_chunk
+        size = size or IN_CHUNK_SIZE
+        oversized = [in_list for in_list in self._in_lists if len(in_list.names) > size]
+        if oversized and temporary and self.action in ('SELECT', 'COUNT', 'UPDATE', 'DELETE'):
+            return self._run_temporary(oversized[0], size, sql_clause, sql_dict, cursor_class)
+        if len(oversized) == 1 and self._splittable(oversized[0]):
+            return self._run_chunks(oversized[0], size, parallel, sql_clause, sql_dict, cursor_class)
+        return self._run_on(None, sql_clause, sql_dict, cursor_class)
+
+    def _splittable(self, in_list):
+        """IN 列表拆分后各语句结果的并集等于原语句结果时返回真。"""
+        return (self.action in ('SELECT', 'UPDATE', 'DELETE') and not in_list.negated and
+                not self._in_disjunctive and not self._limit_clause and not self._order_clause and
+                not self._distinct_clause and not getattr(self, '_group_by_clause', None))
+
+    def _run_chunks(self, in_list, size, parallel, sql_clause, sql_dict, cursor_class):
+        """把 IN 列表分成每批 size 个值的多条语句执行，连接结果或累加影响行数。"""
+        excluded = set(in_list.names)
+        base = dict((k, v) for k, v in sql_dict.items() if k not in excluded)
+        statements = []
+        for start in range(0, len(in_list.names), size):
+            names = in_list.names[start:start + size]
+            chunk_dict = dict(base)
+            chunk_dict.update((name, sql_dict[name]) for name in names)
+            clause = '{0} IN ({1})'.format(in_list.column, _placeholders(names))
+            statements.append((sql_clause.replace(in_list[0], clause, 1), chunk_dict))
+
+        tasks = [lambda sql=sql, chunk_dict=chunk_dict: self._run_on(None, sql, chunk_dict, cursor_class)
+                 for sql, chunk_dict in statements]
+        if parallel and isinstance(self.engine, Pool) and _bound_transaction(self.engine) is None:
+            results = self.engine.gather(tasks)
+        else:
+            results = [task() for task in tasks]
+        if self.action == 'SELECT':
+            result = tuple(chain(*results))
+            self.affected_rows = len(result)
+            return result
+        self.affected_rows = sum(results)
+        return self.affected_rows
+
+    def _run_temporary(self, in_list, size, sql_clause, sql_dict, cursor_class):
+        """把 IN 列表的值写入临时表，以 IN (SELECT ...) 子查询在同一个 Engine 上执行一条语句。"""
+        name = '_lazy_in_%d' % next(_temporary_tables)
+
+        def shape(sql):
+            # one template for every call, whatever the table name
+            return _IN_LIST.sub(' IN (...)', sql.replace(name, '_lazy_in_?'))
+        _engine = self._checkout()
+        failed = True
+        try:
+            sql = 'CREATE TEMPORARY TABLE {0} (INDEX (v)) SELECT {1} AS v FROM {2} LIMIT 0'.format(
+                name, in_list.column, self.table_name)
+            self._execute(_engine, sql, None, None, shape=shape(sql)).close()
+            literal = _engine.connect().literal
+            for start in range(0, len(in_list.names), size):
+                values = ','.join(['(%s)' % literal(sql_dict[key]) for key in in_list.names[start:start + size]])
+                self._execute(_engine, 'INSERT INTO {0} (v) VALUES {1}'.format(name, values), None, None,
+                              shape='INSERT INTO _lazy_in_? (v) VALUES (...)').close()
+            excluded = set(in_list.names)
+            clause = '{0} {1}IN (SELECT v FROM {2})'.format(in_list.column, 'NOT ' if in_list.negated else '', name)
+            sql = sql_clause.replace(in_list[0], clause, 1)
+            result = self._run_on(_engine, sql, dict((k, v) for k, v in sql_dict.items() if k not in excluded),
+                                  cursor_class, shape(sql))
+            sql = 'DROP TEMPORARY TABLE {0}'.format(name)
+            self._execute(_engine, sql, None, None, shape=shape(sql)).close()
+            failed = False
+        except Exception as e:
+            failed = e
+            raise
+        finally:
+            if failed and _engine._tx is None:
+                # the temporary table lives as long as the connection, drop both
+                _engine.close()
+            self._checkin(_engine, failed)
+        return result
+
+    def _run_on(self, _engine, sql_clause, sql_dict, cursor_class, shape=None):
+        """执行语句并按类型读取结果，_engine 为 None 时从连接池获取 Engine；shape 为记录指标时使用的语句模板。"""
+        if _engine is None:
+            _engine = self._checkout()
+            try:
+                cursor = self._execute(_engine, sql_clause, sql_dict, cursor_class, shape=shape)
+            except Exception as e:
+                self._checkin(_engine, e)
+                raise
+            self._checkin(_engine)
+        else:
+            cursor = self._execute(_engine, sql_clause, sql_dict, cursor_class, shape=shape)
+
+        inst = _instrumentation
+        if inst is not None:
+            started = _clock()
         result = None
         if self.action == 'SELECT':
             result = cursor.fetchall()
+            if (cursor_class or _engine.row_format) == 'record':
+                result = _records(cursor.description, result)
         elif self.action == 'INSERT':
             result = cursor.lastrowid
         elif self.action in ('UPDATE', 'DELETE'):
-            result = self.affected_rows
-        elif self.action == 'COUNT':
-            result = cursor.fetchall()[0]['X']
+            result = cursor.rowcount
+        if self.action in ('INSERT', 'UPDATE', 'DELETE') and _caches:
+            _invalidate(self.table_name)
+            if _engine._tx is not None:
+                _engine._tx.written.add(self.table_name)
+        if self.action == 'COUNT':
+            row = cursor.fetchone()
+            # no row only comes from the information_schema estimate, the caller falls back to COUNT()
+            if row is not None:
+                result = row['X'] if isinstance(row, dict) else row[0]
         cursor.close()
+        if inst is not None and self.action in ('SELECT', 'COUNT'):
+            inst.fetch(shape or _shape(sql_clause), _clock() - started, len(result) if self.action == 'SELECT' else 1)
         return result
 
 
@@ -476,12 +2237,143 @@ class _Select(_BaseSession):
         self._group_by_clause = 'GROUP BY %s' % (','.join([str(column) for column in columns]))
         return self
 
-    def go(self, cursor_class=None):
+    def _statement(self):
         clauses = [self.action, self._distinct_clause, self._action_clause, 'FROM', self.table_name,
                    self._where_clause, self._group_by_clause, self._order_clause, self._limit_clause]
-        sql_dict = self._where_dict
+        return clauses, self._where_dict
+
+    def go(self, cursor_class=None):
+        clauses, sql_dict = self._statement()
         return self._transaction(clauses, sql_dict, cursor_class)
 
+    def _stream(self, chunk_size, cursor_class):
+        """使用服务器端游标逐批读取结果，生成 (游标描述, 行) 元组。"""
+        clauses, sql_dict = self._statement()
+        sql_clause = ' '.join([clause for clause in clauses if clause])
+        _engine = self._checkout()
+        exhausted, failed, inst, fetched, elapsed = False, False, _instrumentation, 0, 0.0
+        cursor = None
+        try:
+            cursor = self._execute(_engine, sql_clause, sql_dict, cursor_class, True)
+            record = (cursor_class or _engine.row_format) == 'record'
+            while True:
+                if inst is not None:
+                    started = _clock()
+                rows = cursor.fetchmany(chunk_size)
+                if inst is not None:
+                    elapsed += _clock() - started
+                    fetched += len(rows)
+                if not rows:
+                    break
+                if record:
+                    rows = _records(cursor.description, rows)
+                yield cursor.description, rows
+            exhausted = True
+            cursor.close()
+        except Exception as e:
+            failed = e
+            raise
+        finally:
+            if inst is not None:
+                inst.fetch(_shape(sql_clause), elapsed, fetched)
+            if not exhausted:
+                if _engine._tx is not None:
+                    # the connection carries an open transaction, read the rest instead of dropping it
+                    if cursor is not None and not failed:
+                        while cursor.fetchmany(chunk_size):
+                            pass
+                        cursor.close()
+                else:
+                    # unread rows of an unbuffered result would block the connection, drop it instead.
+                    _engine.close()
+            self._checkin(_engine, failed)
+
+    def iter(self, chunk_size=1000, chunked=False, cursor_class=None):
+        """使用服务器端游标流式读取结果，返回生成器。
+        生成器耗尽或被关闭之前一直占用同一个 Engine 对象。
+        :param chunk_size: 每次从服务器读取的行数。
+        :param chunked: 为真时每次返回一批行组成的列表，否则逐行返回。
+        :param cursor_class: 游标类型，与 go() 相同。
+        """
+        stream = self._stream(chunk_size, cursor_class)
+        try:
+            for description, rows in stream:
+                if chunked:
+                    yield list(rows)
+                else:
+                    for row in rows:
+                        yield row
+        finally:
+            stream.close()
+
+    def go_columnar(self, use_numpy=True):
+        """
+        按列返回结果：ColumnarResult，字段名称 -> 列数据。
+        整数列与浮点数列为 NumPy 数组（未安装 NumPy 或 use_numpy 为假时为 array.array），其他列为对象数组或 list。
+        DECIMAL 列保留 Decimal 对象；整数超出 C long 范围的列（如 BIGINT UNSIGNED）改为对象列。
+        含 NULL 的列在 masks 属性中记录掩码，NumPy 模式下该列为 numpy.ma.MaskedArray。
+        """
+        clauses, sql_dict = self._statement()
+        sql_clause = ' '.join([clause for clause in clauses if clause])
+        _engine = self._checkout()
+        try:
+            cursor = self._execute(_engine, sql_clause, sql_dict, 'tuple')
+        except Exception as e:
+            self._checkin(_engine, e)
+            raise
+        self._checkin(_engine)
+        columns = _Columns(cursor.description)
+        columns.add(cursor.fetchall())
+        cursor.close()
+        return columns.result(use_numpy)
+
+    def iter_columnar(self, chunk_size=10000, use_numpy=True):
+        """使用服务器端游标流式读取，每 chunk_size 行生成一个 ColumnarResult。"""
+        stream = self._stream(chunk_size, 'tuple')
+        try:
+            for description, rows in stream:
+                columns = _Columns(description)
+                columns.add(rows)
+                yield columns.result(use_numpy)
+        finally:
+            stream.close()
+
+    def export_to(self, target, format='csv', chunk_size=10000):
+        """
+        使用服务器端游标把结果流式写入文件，每次只缓冲 chunk_size 行。
+        :param target: 文件路径或以二进制方式打开的文件对象，文件对象不会被关闭。
+        :param format: csv, tsv 或 jsonl；csv 与 tsv 的格式与 Table.load_from() 相同。
+        :return: {'rows': 行数, 'bytes': 写入字节数, 'seconds': 耗时, 'rows_per_sec': 每秒行数}。
+        """
+        if format not in ('csv', 'tsv', 'jsonl'):
+            raise ValueError('unknown export format: %s' % format)
+        started = _clock()
+        rows_written = bytes_written = 0
+        output = open(target, 'wb') if isinstance(target, basestring) else target
+        stream = self._stream(chunk_size, 'tuple')
+        try:
+            for description, rows in stream:
+                if format == 'jsonl':
+                    names = [d[0] for d in description]
+                    data = ''.join([json.dumps(dict(zip(names, row)), default=str) + '\n' for row in rows])
+                else:
+                    data = _text_lines(rows, format)
+                output.write(data)
+                rows_written += len(rows)
+                bytes_written += len(data)
+        finally:
+            stream.close()
+            if output is not target:
+                output.close()
+        return _throughput(rows_written, bytes_written, started)
+
+    def iter_async(self, chunk_size=1000, prefetch=2, cursor_class=None):
+        """
+        在 AsyncPool 的工作线程中执行 iter()，返回预读数据的行迭代器。
+        :param prefetch: 预读的批数，缓冲区满时工作线程暂停读取。
+        """
+        return _AsyncRows(self, chunk_size, prefetch, cursor_class)
+
 
 class _Insert(_BaseSession):
     def __init__(self, engine, table_name, action, *columns, **assignments):
@@ -489,23 +2381,531 @@ class _Insert(_BaseSession):
         self._action_clause = ', '.join(['{0}=%(_insert_{0})s'.format(k) for k in self._assignments])
         self._action_dict = dict(('_insert_%s' % k, v) for k, v in self._assignments.items())
 
+    def _statement(self):
+        return [self.action, 'INTO', self.table_name, 'SET', self._action_clause], self._action_dict
+
     def go(self, cursor_class=None):
-        clauses = [self.action, 'INTO', self.table_name, 'SET', self._action_clause]
-        sql_dict = self._action_dict
+        clauses, sql_dict = self._statement()
         return self._transaction(clauses, sql_dict, cursor_class)
 
 
+class _AsyncRows(object):
+    """
+    由工作线程预读数据的行迭代器，缓冲区最多保存 prefetch 批数据。
+    调用 close()、离开 with 代码块、迭代结束或迭代器被回收后，工作线程关闭服务器端游标并归还 Engine。
+    """
+
+    def __init__(self, session, chunk_size, prefetch, cursor_class):
+        self._chunks = Queue(prefetch)
+        self._stopped = Event()
+        self._rows = iter(())
+        self._done = False
+        # the worker only gets the queue and the event, so dropping the iterator lets __del__ stop it
+        self.future = session._executor().submit(
+            _produce_chunks, session, chunk_size, cursor_class, self._chunks, self._stopped)
+
+    def __del__(self):
+        self._stopped.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next_chunk(self, timeout=None):
+        """返回下一批数据组成的列表，结束后返回 None，超时抛出 FutureTimeout。"""
+        if self._done:
+            return None
+        try:
+            chunk = self._chunks.get(timeout=timeout)
+        except Empty:
+            raise FutureTimeout()
+        if chunk is None or isinstance(chunk, Exception):
+            self._done = True
+            self._stopped.set()
+            if chunk is not None:
+                raise chunk
+        return chunk
+
+    def next(self):
+        for row in self._rows:
+            return row
+        chunk = self.next_chunk()
+        if chunk is None:
+            raise StopIteration
+        self._rows = iter(chunk)
+        return self.next()
+
+    __next__ = next
+
+    def close(self):
+        """停止预读，未开始的任务被取消，正在读取的任务放弃剩余数据并归还 Engine。"""
+        self._done = True
+        self._stopped.set()
+        self.future.cancel()
+
+
+def _produce_chunks(session, chunk_size, cursor_class, chunks, stopped):
+    """_AsyncRows 的工作线程：把各批数据放入 chunks，stopped 被设置后放弃剩余数据。"""
+    rows = session.iter(chunk_size, True, cursor_class)
+    try:
+        for chunk in rows:
+            if not _offer(chunks, stopped, chunk):
+                return
+        _offer(chunks, stopped, None)
+    except Exception as e:
+        _offer(chunks, stopped, e)
+    finally:
+        rows.close()
+
+
+def _offer(chunks, stopped, item):
+    while not stopped.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+class _InsertMany(_BaseSession):
+    """多行 INSERT，按行数上限与 max_allowed_packet 自动分批。"""
+    _PACKET_MARGIN = 1024   # reserved bytes for packet header and statement overhead
+    _RETURNS_IDS = True
+
+    def __init__(self, engine, table_name, action, rows, columns=None, max_rows=1000, max_packet=None):
+        """
+        :param rows: 由 dict 或 tuple 组成的列表或任意可迭代对象。
+        :param columns: 字段名称列表，rows 为 tuple 时必须提供，为 dict 时默认取第一行的键。
+        :param max_rows: 每批最多插入的行数。
+        :param max_packet: 每批语句的最大字节数，默认读取服务器的 max_allowed_packet。
+        """
+        super(_InsertMany, self).__init__(engine, table_name, action)
+        self._rows = rows
+        self._fields = [str(column) for column in columns] if columns else None
+        self._max_rows = max_rows
+        self._max_packet = max_packet
+        self.affected_rows = []
+
+    def _values(self, row):
+        if isinstance(row, dict):
+            return [row[field] for field in self._fields]
+        return row
+
+    def _prepare(self, first):
+        """根据第一行确定字段列表。"""
+        if self._fields is None:
+            if not isinstance(first, dict):
+                raise ValueError('columns is required when rows are not dicts')
+            self._fields = list(first.keys())
+
+    def _render(self, literal, row):
+        """转义一行数据，返回 (语句片段, 字节数)。"""
+        value = '(%s)' % ','.join([literal(v) for v in self._values(row)])
+        return value, len(value) + 1
+
+    def _sql(self, batch):
+        return 'INSERT INTO {0} ({1}) VALUES {2}'.format(self.table_name, ', '.join(self._fields), ','.join(batch))
+
+    def _template(self):
+        """不含数据的语句模板，用于度量。"""
+        return self._sql(['(...)'])
+
+    def _batches(self, _engine, rows):
+        """按行数上限与数据包大小生成每一批的语句片段列表。"""
+        budget = (self._max_packet or _engine.max_allowed_packet) - len(self._sql([])) - self._PACKET_MARGIN
+        batch, size = [], 0
+        for row in rows:
+            item, length = self._render(_engine.connect().literal, row)
+            if batch and (len(batch) >= self._max_rows or size + length > budget):
+                yield batch
+                batch, size = [], 0
+            batch.append(item)
+            size += length
+        if batch:
+            yield batch
+
+    def go(self, cursor_class=None):
+        """
+        执行批量语句，返回 {'affected_rows': 各批影响行数}，
+        insert_many() 另外返回 'ids': 各批的 (首个自增ID, 最后一个自增ID)，没有自增ID时为 (None, None)。
+        其他会话的插入可能落在两批之间，因此不提供跨批次的ID范围。
+        """
+        returns_ids = self.action == 'INSERT' and self._RETURNS_IDS
+        result = {'affected_rows': []}
+        if returns_ids:
+            result['ids'] = []
+        rows = iter(self._rows)
+        try:
+            first = next(rows)
+        except StopIteration:
+            return result
+        self._prepare(first)
+        rows = chain([first], rows)
+
+        template = self._template()
+        _engine = self._checkout()
+        try:
+            for batch in self._batches(_engine, rows):
+                cursor = self._execute(_engine, self._sql(batch), None, cursor_class, shape=template)
+                if returns_ids:
+                    # the ids of one statement are consecutive with innodb_autoinc_lock_mode 0 or 1
+                    first_id = cursor.lastrowid or None
+                    result['ids'].append((first_id, first_id + self.affected_rows - 1) if first_id else (None, None))
+                result['affected_rows'].append(self.affected_rows)
+                cursor.close()
+        finally:
+            self._checkin(_engine)
+            if result['affected_rows'] and _caches:
+                _invalidate(self.table_name)
+                if _engine._tx is not None:
+                    _engine._tx.written.add(self.table_name)
+        self.affected_rows = result['affected_rows']
+        return result
+
+
+class _UpsertMany(_InsertMany):
+    """多行 INSERT ... ON DUPLICATE KEY UPDATE col=VALUES(col)。"""
+    # affected rows count updated rows twice and unchanged rows not at all, so no id range can be derived
+    _RETURNS_IDS = False
+
+    def __init__(self, engine, table_name, action, rows, key=None, update=None, columns=None, max_rows=1000,
+                 max_packet=None):
+        """
+        :param key: 唯一键字段，未指定 update 时不更新这些字段。
+        :param update: 发生键冲突时更新的字段，默认为除 key 以外的所有字段。
+        其他参数与 insert_many() 相同。
+        """
+        super(_UpsertMany, self).__init__(engine, table_name, action, rows, columns, max_rows, max_packet)
+        self._keys = _names(key)
+        self._updates = _names(update) if update else None
+
+    def _prepare(self, first):
+        super(_UpsertMany, self)._prepare(first)
+        if self._updates is None:
+            self._updates = [field for field in self._fields if field not in self._keys]
+
+    def _sql(self, batch):
+        assignments = ', '.join(['{0}=VALUES({0})'.format(field) for field in self._updates])
+        return '{0} ON DUPLICATE KEY UPDATE {1}'.format(super(_UpsertMany, self)._sql(batch), assignments)
+
+
+class _UpdateMany(_InsertMany):
+    """
+    按行更新不同的值：UPDATE t SET col = CASE key WHEN ... THEN ... ELSE col END WHERE key IN (...)，
+    复合键使用 CASE WHEN (a=... AND b=...) THEN ... 与 (a, b) IN ((...), (...))。
+    """
+
+    def __init__(self, engine, table_name, action, rows, key, columns=None, max_rows=1000, max_packet=None):
+        """
+        :param key: 定位行的键字段，Column 对象或字段名称，复合键使用它们组成的 tuple 或 list。
+        其他参数与 insert_many() 相同，columns 必须包含键字段。
+        """
+        super(_UpdateMany, self).__init__(engine, table_name, action, rows, columns, max_rows, max_packet)
+        self._keys = _names(key)
+
+    def _prepare(self, first):
+        super(_UpdateMany, self)._prepare(first)
+        missing = [key for key in self._keys if key not in self._fields]
+        if missing:
+            raise ValueError('key field(s) missing from rows: %s' % ', '.join(missing))
+        self._key_index = [self._fields.index(key) for key in self._keys]
+        self._set_index = [i for i, field in enumerate(self._fields) if field not in self._keys]
+
+    def _render(self, literal, row):
+        literals = [literal(v) for v in self._values(row)]
+        keys = [literals[i] for i in self._key_index]
+        values = [literals[i] for i in self._set_index]
+        if len(keys) == 1:
+            condition = target = keys[0]
+        else:
+            condition = '({0})'.format(' AND '.join(['%s=%s' % pair for pair in zip(self._keys, keys)]))
+            target = '({0})'.format(','.join(keys))
+        size = (len(condition) + 11) * len(values) + sum([len(value) for value in values]) + len(target) + 1
+        return (condition, target, values), size
+
+    def _sql(self, batch):
+        single = len(self._keys) == 1
+        assignments = []
+        for position, index in enumerate(self._set_index):
+            field = self._fields[index]
+            whens = ' '.join(['WHEN %s THEN %s' % (item[0], item[2][position]) for item in batch])
+            assignments.append('{0} = CASE {1}{2} ELSE {0} END'.format(field, self._keys[0] + ' ' if single else '', whens))
+        target = self._keys[0] if single else '({0})'.format(', '.join(self._keys))
+        return 'UPDATE {0} SET {1} WHERE {2} IN ({3})'.format(
+            self.table_name, ', '.join(assignments), target, ','.join([item[1] for item in batch]))
+
+    def _template(self):
+        assignments = ', '.join(['{0} = CASE ... END'.format(self._fields[i]) for i in self._set_index])
+        return 'UPDATE {0} SET {1} WHERE ... IN (...)'.format(self.table_name, assignments)
+
+
+class _LoadData(_BaseSession):
+    """LOAD DATA LOCAL INFILE 批量导入，数据行先流式写入临时文件，内存占用与数据量无关。"""
+    _FIELDS = {
+        'csv': "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY ''",
+        'tsv': "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\'",
+    }
+
+    def __init__(self, engine, table_name, action, source, columns=None, format='csv', ignore_lines=0):
+        """
+        :param source: 数据行（dict 或 tuple）组成的可迭代对象，或已按 format 格式写好的文件路径、文件对象。
+        :param columns: 字段名称列表，数据行为 tuple 时必须提供，为 dict 时默认取第一行的键。
+        :param format: csv 或 tsv。csv 以逗号分隔，字符串用双引号包围并以两个双引号转义，NULL 写作不带引号的 NULL；
+                       tsv 为 MySQL 的默认格式，以制表符分隔，反斜杠转义，NULL 写作 \\N。
+        :param ignore_lines: 跳过文件开头的行数，例如表头。
+        """
+        super(_LoadData, self).__init__(engine, table_name, action)
+        if format not in self._FIELDS:
+            raise ValueError('unknown load format: %s' % format)
+        self._source = source
+        self._fields = [str(column) for column in columns] if columns else None
+        self._format = format
+        self._ignore_lines = ignore_lines
+
+    def _write_rows(self, output):
+        """把数据行写入临时文件，返回 (行数, 字节数)。"""
+        rows = iter(self._source)
+        try:
+            first = next(rows)
+        except StopIteration:
+            return 0, 0
+        if self._fields is None:
+            if not isinstance(first, dict):
+                raise ValueError('columns is required when rows are not dicts')
+            self._fields = list(first.keys())
+        fields, count, size, batch = self._fields, 0, 0, []
+        for row in chain([first], rows):
+            batch.append([row[field] for field in fields] if isinstance(row, dict) else row)
+            if len(batch) >= 10000:
+                data = _text_lines(batch, self._format)
+                output.write(data)
+                count, size, batch = count + len(batch), size + len(data), []
+        data = _text_lines(batch, self._format)
+        output.write(data)
+        return count + len(batch), size + len(data)
+
+    def go(self, cursor_class=None):
+        """
+        执行导入，返回 {'rows': 导入行数, 'bytes': 数据文件字节数, 'seconds': 耗时, 'rows_per_sec': 每秒行数}。
+        Engine 或 Pool 需要以 local_infile=True 创建。
+        """
+        started = _clock()
+        path, temporary = self._source, None
+        try:
+            if not isinstance(self._source, basestring):
+                temporary = tempfile.NamedTemporaryFile(prefix='lazy_mysql_', suffix='.' + self._format, delete=False)
+                path = temporary.name
+                with temporary:
+                    if hasattr(self._source, 'read'):
+                        shutil.copyfileobj(self._source, temporary)
+                    elif not self._write_rows(temporary)[0]:
+                        return _throughput(0, 0, started)
+            size = os.path.getsize(path)
+
+            _engine = self._checkout()
+            try:
+                sql = 'LOAD DATA LOCAL INFILE {0} INTO TABLE {1} CHARACTER SET {2} {3}'.format(
+                    _engine.connect().literal(path), self.table_name, _engine.charset, self._FIELDS[self._format])
+                sql += " LINES TERMINATED BY '\\n'"
+                if self._ignore_lines:
+                    sql += ' IGNORE %d LINES' % self._ignore_lines
+                if self._fields:
+                    sql += ' ({0})'.format(', '.join(self._fields))
+                cursor = self._execute(_engine, sql, None, None, shape='LOAD DATA LOCAL INFILE INTO ' + self.table_name)
+                cursor.close()
+            except Exception as e:
+                self._checkin(_engine, e)
+                raise
+            self._checkin(_engine)
+        finally:
+            if temporary is not None:
+                os.remove(temporary.name)
+            if _caches:
+                _invalidate(self.table_name)
+        return _throughput(self.affected_rows, size, started)
+
+
+def _throughput(rows, size, started):
+    elapsed = _clock() - started
+    return {'rows': rows, 'bytes': size, 'seconds': elapsed, 'rows_per_sec': rows / elapsed if elapsed > 0 else 0.0}
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _csv_field(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, long, float)):
+        return _text(value)
+    return '"%s"' % _text(value).replace('"', '""')
+
+
+_TSV_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'), ('\0', '\\0'))
+
+
+def _tsv_field(value):
+    if value is None:
+        return '\\N'
+    text = _text(value)
+    for char, escaped in _TSV_ESCAPES:
+        if char in text:
+            text = text.replace(char, escaped)
+    return text
+
+
+def _text_lines(rows, format):
+    """把若干行格式化为 csv 或 tsv 文本。"""
+    field, separator = (_csv_field, ',') if format == 'csv' else (_tsv_field, '\t')
+    return ''.join([separator.join([field(value) for value in row]) + '\n' for row in rows])
+
+
+class _BufferedWriter(object):
+    """
+    缓冲写入器，后台线程在行数达到 max_rows 或等待超过 max_delay_ms 时通过 insert_many() 写入。
+    close() 或进程退出时写入剩余的行，字段相同的行合并为同一条语句。
+    """
+
+    def __init__(self, table, max_rows=1000, max_delay_ms=100, max_queue=None, on_error=None):
+        self.table = table
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.on_error = on_error
+        self.written = self.failed = 0
+        self.closed = False
+        self._queue = Queue(max_queue or max_rows * 10)
+        self._thread = Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+        _writers.add(self)
+
+    def insert(self, **row):
+        """把一行放入队列，队列满时阻塞直到后台线程腾出空间。"""
+        if self.closed:
+            raise ValueError('insert into a closed buffered writer')
+        self._queue.put(row)
+
+    @property
+    def pending(self):
+        """队列中尚未写入的行数（近似值）。"""
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        """写入调用之前放入队列的所有行，返回是否在 timeout 秒内完成。"""
+        if self.closed:
+            return True
+        done = Event()
+        self._queue.put(done)
+        return done.wait(timeout) or done.is_set()
+
+    def close(self):
+        """写入剩余的行并结束后台线程，可以重复调用。"""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _work(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            batch, flushed = [], []
+            deadline = _clock() + self.max_delay
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                if not isinstance(item, dict):
+                    # an Event put by flush()
+                    flushed.append(item)
+                    break
+                batch.append(item)
+                remaining = deadline - _clock()
+                if len(batch) >= self.max_rows or remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for event in flushed:
+                event.set()
+
+    def _write(self, batch):
+        """按字段分组写入一批行，失败的分组交给 on_error。"""
+        groups = OrderedDict()
+        for row in batch:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for fields, rows in groups.items():
+            try:
+                self.table.insert_many(rows, fields, self.max_rows).go()
+                self.written += len(rows)
+            except Exception as e:
+                self.failed += len(rows)
+                if self.on_error is None:
+                    logger.exception('buffered insert of %d rows into %s failed: %s', len(rows), self.table.table_name, e)
+                    continue
+                try:
+                    self.on_error(e, rows)
+                except Exception as error:
+                    logger.exception(str(error))
+
+
+_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_writers():
+    """进程退出时写入所有缓冲写入器中剩余的行。"""
+    for writer in list(_writers):
+        writer.close()
+
+
+def _names(columns):
+    """把 Column 对象、字段名称或它们组成的序列转换为字段名称列表。"""
+    if columns is None:
+        return []
+    if isinstance(columns, (tuple, list)):
+        return [str(column) for column in columns]
+    return [str(columns)]
+
+
 class _Update(_BaseSession):
     def __init__(self, engine, table_name, action, *columns, **assignments):
         super(_Update, self).__init__(engine, table_name, action, *columns, **assignments)
         self._action_clause = ', '.join(['{0}=%(_update_{0})s'.format(k) for k in self._assignments])
         self._action_dict = dict(('_update_%s' % k, v) for k, v in self._assignments.items())
 
-    def go(self, cursor_class=None):
+    def _statement(self):
         clauses = [self.action, self.table_name, 'SET', self._action_clause, self._where_clause,
                    self._order_clause, self._limit_clause]
         sql_dict = dict()
         sql_dict.update(self._action_dict, **self._where_dict)
+        return clauses, sql_dict
+
+    def go(self, cursor_class=None):
+        clauses, sql_dict = self._statement()
         return self._transaction(clauses, sql_dict, cursor_class)
 
 
@@ -513,9 +2913,12 @@ class _Delete(_BaseSession):
     def __init__(self, engine, table_name, action, *columns, **assignments):
         super(_Delete, self).__init__(engine, table_name, action, *columns, **assignments)
 
-    def go(self, cursor_class=None):
+    def _statement(self):
         clauses = [self.action, 'FROM', self.table_name, self._where_clause, self._order_clause, self._limit_clause]
-        sql_dict = self._where_dict
+        return clauses, self._where_dict
+
+    def go(self, cursor_class=None):
+        clauses, sql_dict = self._statement()
         return self._transaction(clauses, sql_dict, cursor_class)
 
 
@@ -525,11 +2928,698 @@ class _Count(_BaseSession):
         col, distinct = self._columns
         self._action_clause = ' '.join(['DISTINCT' if col and distinct else '', "'*'" if col is None else str(col)])
         self._action_clause = 'COUNT({0})'.format(self._action_clause)
+        self._approximate, self._exact_below = False, None
 
-    def go(self, cursor_class=None):
+    def approximate(self, flag=True, exact_below=None):
+        """
+        返回估算的行数而不扫描数据：没有条件时读取 information_schema.TABLES 的 TABLE_ROWS，
+        有条件时读取 EXPLAIN 的 rows 与 filtered 估算值。InnoDB 的估算误差可达 40% 以上，COUNT(DISTINCT) 仍精确计数。
+        :param exact_below: 估算值小于该值时改为精确计数，避免小结果集的明显误差。
+        """
+        self._approximate, self._exact_below = flag, exact_below
+        return self
+
+    def _statement(self):
         clauses = ['SELECT', self._action_clause, 'AS X FROM', self.table_name, self._where_clause, self._limit_clause]
-        sql_dict = self._where_dict
-        return self._transaction(clauses, sql_dict, cursor_class)
+        return clauses, self._where_dict
+
+    def _estimate_statement(self):
+        if self._where_clause:
+            return ['EXPLAIN SELECT 1 FROM', self.table_name, self._where_clause], self._where_dict
+        schema, _, name = self.table_name.rpartition('.')
+        sql_dict = {'_count_table': name.strip('`')}
+        if schema:
+            sql_dict['_count_schema'] = schema.strip('`')
+        clauses = ['SELECT TABLE_ROWS AS X FROM information_schema.TABLES',
+                   'WHERE TABLE_SCHEMA = %(_count_schema)s' if schema else 'WHERE TABLE_SCHEMA = DATABASE()',
+                   'AND TABLE_NAME = %(_count_table)s']
+        return clauses, sql_dict
+
+    def go(self, cursor_class=None):
+        """返回计数，不受行格式影响。"""
+        if self._approximate and not (self._columns[0] is not None and self._columns[1]):
+            clauses, sql_dict = self._estimate_statement()
+            estimate = self._transaction(clauses, sql_dict, 'tuple')
+            if estimate is not None and (self._exact_below is None or estimate >= self._exact_below):
+                return estimate
+        clauses, sql_dict = self._statement()
+        return self._transaction(clauses, sql_dict, 'tuple')
+
+    def _run(self, sql_clause, sql_dict, cursor_class):
+        if not sql_clause.startswith('EXPLAIN'):
+            return super(_Count, self)._run(sql_clause, sql_dict, cursor_class)
+        _engine = self._checkout()
+        try:
+            cursor = self._execute(_engine, sql_clause, sql_dict, 'dict')
+        except Exception as e:
+            self._checkin(_engine, e)
+            raise
+        self._checkin(_engine)
+        plan = cursor.fetchall()
+        cursor.close()
+        if not plan or plan[0].get('rows') is None:
+            return None
+        # rows examined, scaled by the share the remaining conditions keep (MySQL 5.7+)
+        return int(plan[0]['rows'] * float(plan[0].get('filtered') or 100) / 100)
+
+
+class _Compiled(object):
+    """编译后的语句，保存 SQL 文本与参数映射，可以反复执行。"""
+
+    def __init__(self, session, sql, sql_dict):
+        self.session, self.sql = session, sql
+        self._static = dict((k, v) for k, v in sql_dict.items() if not isinstance(v, Param))
+        self._params = [(k, v.name) for k, v in sql_dict.items() if isinstance(v, Param)]
+
+    def go(self, cursor_class=None, **params):
+        """使用关键字参数替换 Param 占位符并执行语句，返回值与原语句的 go() 相同，启用的结果缓存同样有效。"""
+        sql_dict = dict(self._static)
+        for key, name in self._params:
+            sql_dict[key] = params[name]
+        return self.session._transaction([self.sql], sql_dict, cursor_class)
+
+
+# mysql_set_option values for mysql_set_server_option()
+_MULTI_STATEMENTS_ON, _MULTI_STATEMENTS_OFF = 0, 1
+
+
+class _Pipeline(object):
+    """
+    语句管道：把多个会话的语句在客户端转义后用分号连接，作为一个多语句数据包发送，
+    再用 nextset() 依次读取各结果集，一次往返完成全部语句。
+    """
+
+    def __init__(self, source):
+        """
+        :param source: Engine, Pool 或 RoutingPool 对象。
+        """
+        self.source = source
+        self.sessions = []
+
+    def add(self, *sessions):
+        """加入 select(), count(), insert(), update(), delete() 返回的会话。"""
+        for session in sessions:
+            if not isinstance(session, (_Select, _Count, _Insert, _Update, _Delete)):
+                raise TypeError('cannot pipeline %s' % session.__class__.__name__)
+            self.sessions.append(session)
+        return self
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _result(self, session, cursor, row_format):
+        """按会话 go() 的返回形式读取当前结果集。"""
+        if session.action == 'SELECT':
+            result = cursor.fetchall()
+            return _records(cursor.description, result) if row_format == 'record' else result
+        if session.action == 'COUNT':
+            row = cursor.fetchone()
+            return row['X'] if isinstance(row, dict) else row[0]
+        if session.action == 'INSERT':
+            return cursor.lastrowid
+        return cursor.rowcount
+
+    def go(self, cursor_class=None):
+        """
+        执行管道中的全部语句，按加入顺序返回结果列表。
+        某条语句出错时抛出该异常，之前的语句已经执行，之后的语句不会执行。
+        """
+        if not self.sessions:
+            return []
+        writes = set([session.table_name for session in self.sessions if session.action not in RoutingPool.READS])
+        _engine = _checkout(self.source, 'INSERT' if writes else 'SELECT')
+        row_format = cursor_class or _engine.row_format
+        inst, failed, results = _instrumentation, True, []
+        try:
+            conn = _engine.connect(cursor_class)
+            shapes, statements = [], []
+            for session in self.sessions:
+                clauses, sql_dict = session._statement()
+                sql_clause = ' '.join([clause for clause in clauses if clause])
+                shapes.append(_shape(sql_clause))
+                statements.append(sql_clause % dict((k, conn.literal(v)) for k, v in sql_dict.items()))
+            sql = ';\n'.join(statements)
+            if inst is not None:
+                started = _clock()
+            conn.set_server_option(_MULTI_STATEMENTS_ON)
+            try:
+                cursor = conn.cursor()
+                _engine.affected_rows = cursor.execute(sql)
+                _engine.last_executed = sql
+                for index, session in enumerate(self.sessions):
+                    if index and not cursor.nextset():
+                        raise MySQLdb.InterfaceError('missing result set for statement %d' % index)
+                    results.append(self._result(session, cursor, row_format))
+                cursor.close()
+            finally:
+                if len(results) < len(self.sessions):
+                    # unread result sets block the connection, drop it instead
+                    _engine.close()
+                else:
+                    conn.set_server_option(_MULTI_STATEMENTS_OFF)
+            if inst is not None:
+                inst.execute('; '.join(shapes), _clock() - started)
+            failed = False
+        except Exception as e:
+            failed = e
+            raise
+        finally:
+            _checkin(self.source, _engine, failed)
+            if writes and _caches:
+                for table_name in writes:
+                    _invalidate(table_name)
+                    if _engine._tx is not None:
+                        _engine._tx.written.add(table_name)
+        return results
+
+
+class _Scan(object):
+    """
+    使用 WHERE key > last_seen ORDER BY key LIMIT n 逐页遍历数据表，每页的查询代价与遍历深度无关。
+    迭代时逐行返回 dict，checkpoint 属性记录最后返回的一行的键值，可作为 start 参数恢复遍历。
+    并行分段遍历时各段的进度互不相关，不记录 checkpoint，也不接受 start。
+    """
+
+    def __init__(self, table, key, batch_size=1000, where=None, columns=None, start=None, slices=None):
+        """
+        :param table: Table 对象。
+        :param key: 键字段，Column 对象或字段名称，复合键使用由它们组成的 tuple 或 list。
+        :param batch_size: 每页读取的行数。
+        :param where: 附加条件，单个 Column 条件或其列表，各条件之间为 AND 关系。
+        :param columns: 读取的字段，默认读取全部字段，键字段会被自动加入。
+        :param start: 从该键值之后开始遍历（不含），复合键使用 tuple。
+        :param slices: 将第一个键字段的取值范围切分为若干段，通过 Pool 并行遍历，仅支持整数键。
+        """
+        if slices and slices > 1 and start is not None:
+            raise ValueError('a parallel scan cannot resume from start, scan sequentially to use checkpoints')
+        self.table, self.batch_size, self.slices = table, batch_size, slices
+        self.keys = [str(k) for k in key] if isinstance(key, (tuple, list)) else [str(key)]
+        if where and isinstance(where, tuple) and isinstance(where[0], basestring):
+            where = [where]
+        self.where = list(where or [])
+        self.columns = list(columns or [])
+        if self.columns:
+            self.columns += [k for k in self.keys if k not in [str(c) for c in self.columns]]
+        self.checkpoint = start
+
+    def _after(self, last):
+        """生成 (k1, k2, ...) > (v1, v2, ...) 的展开条件。"""
+        last = last if isinstance(last, (tuple, list)) else (last,)
+        names = ['_scan_%s' % index for index in range(len(self.keys))]
+        ors = []
+        for index, key in enumerate(self.keys):
+            ands = ['{0}=%({1})s'.format(k, n) for k, n in zip(self.keys[:index], names[:index])]
+            ands.append('{0}>%({1})s'.format(key, names[index]))
+            ors.append(' AND '.join(ands))
+        return '({0})'.format(' OR '.join(['({0})'.format(o) for o in ors])), dict(zip(names, last))
+
+    def _key(self, row):
+        return row[self.keys[0]] if len(self.keys) == 1 else tuple([row[k] for k in self.keys])
+
+    def _pages(self, start=None, bounds=None):
+        """逐页读取，bounds 为第一个键字段的 (下限, 上限) 闭区间。"""
+        last = start
+        while True:
+            conditions = list(self.where)
+            if bounds is not None:
+                conditions.append(('{0} BETWEEN %(_scan_floor)s AND %(_scan_ceil)s'.format(self.keys[0]),
+                                   {'_scan_floor': bounds[0], '_scan_ceil': bounds[1]}))
+            if last is not None:
+                conditions.append(self._after(last))
+            session = self.table.select(*self.columns).limit(self.batch_size)
+            if conditions:
+                session.where(*conditions)
+            session._order_clause = 'ORDER BY {0}'.format(', '.join(['%s ASC' % k for k in self.keys]))
+            rows = session.go('dict')
+            if not rows:
+                return
+            yield rows
+            if len(rows) < self.batch_size:
+                return
+            last = self._key(rows[-1])
+
+    def _ranges(self):
+        session = self.table.select('MIN({0}) AS lo'.format(self.keys[0]), 'MAX({0}) AS hi'.format(self.keys[0]))
+        if self.where:
+            session.where(*self.where)
+        rows = session.go('dict')
+        lo, hi = rows[0]['lo'], rows[0]['hi']
+        if lo is None:
+            return []
+        step = max((hi - lo + 1) // self.slices, 1)
+        floors = range(lo, hi + 1, step)[:self.slices]
+        return [(floor, floors[i + 1] - 1 if i + 1 < len(floors) else hi) for i, floor in enumerate(floors)]
+
+    def _parallel(self):
+        if not isinstance(self.table.engine, (Pool, RoutingPool)):
+            raise ValueError('parallel scan requires a Pool')
+        ranges = self._ranges()
+        pages, stop = Queue(len(ranges) * 2 or 1), Event()
+
+        def offer(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def worker(bounds):
+            try:
+                for rows in self._pages(None, bounds):
+                    if not offer(rows):
+                        return
+                offer(None)
+            except Exception as e:
+                offer(e)
+
+        for bounds in ranges:
+            thread = Thread(target=worker, args=(bounds,))
+            thread.daemon = True
+            thread.start()
+        try:
+            remaining = len(ranges)
+            while remaining:
+                rows = pages.get()
+                if rows is None:
+                    remaining -= 1
+                elif isinstance(rows, Exception):
+                    raise rows
+                else:
+                    for row in rows:
+                        yield row
+        finally:
+            stop.set()
+
+    def __iter__(self):
+        if self.slices and self.slices > 1:
+            for row in self._parallel():
+                yield row
+            return
+        for rows in self._pages(self.checkpoint):
+            for row in rows:
+                # set before yielding so the consumer sees the row it is handling
+                self.checkpoint = self._key(row)
+                yield row
+
+
+class Modulo(object):
+    """按键值取模分片，非整数键先计算 CRC32。"""
+
+    def __call__(self, value, count):
+        if not isinstance(value, (int, long)):
+            value = zlib.crc32(_hash_key(value)) & 0xffffffff
+        return value % count
+
+
+class Range(object):
+    """按键值范围分片，bounds 为第 2 到第 n 个分片的起始值，升序排列。"""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+
+    def __call__(self, value, count):
+        index = bisect_right(self.bounds, value)
+        if index >= count:
+            raise ValueError('no shard for key %r' % (value,))
+        return index
+
+
+class ConsistentHash(object):
+    """一致性哈希分片，增加分片时只有约 1/n 的键改变分片。"""
+
+    def __init__(self, points=100):
+        """
+        :param points: 每个分片在哈希环上的虚拟节点数。
+        """
+        self.points = points
+        self._rings = {}
+
+    def _ring(self, count):
+        ring = self._rings.get(count)
+        if ring is None:
+            nodes = sorted((_hash(_hash_key('shard-%d-%d' % (shard, point))), shard)
+                           for shard in range(count) for point in range(self.points))
+            ring = self._rings[count] = ([node[0] for node in nodes], [node[1] for node in nodes])
+        return ring
+
+    def __call__(self, value, count):
+        hashes, shards = self._ring(count)
+        return shards[bisect_right(hashes, _hash(_hash_key(value))) % len(hashes)]
+
+
+def _hash_key(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
+def _hash(data):
+    return int(hashlib.md5(data).hexdigest()[:8], 16)
+
+
+class ShardedTable(Table):
+    """
+    按分片键分布在多个 Engine 或 Pool 上的数据表。
+    条件中固定了分片键（key == v 或 key.in_(...)）的语句只发往对应的分片，其他语句并行发往所有分片并合并结果。
+    """
+
+    def __init__(self, table_name, shards, key, sharding=None, *columns):
+        """
+        :param table_name: 数据表名称，各分片相同。
+        :param shards: 各分片的 Engine 或 Pool 对象列表。
+        :param key: 分片键，Column 对象或字段名称。
+        :param sharding: 分片函数 fn(value, count) -> 分片序号，默认为 Modulo()。
+        :param columns: 字段。
+        """
+        super(ShardedTable, self).__init__(table_name, None, *columns)
+        self.key = str(key)
+        self.sharding = sharding or Modulo()
+        self.tables = []
+        for engine in shards:
+            self.add_shard(engine)
+
+    def add_shard(self, engine):
+        """增加一个分片，已有数据需要另行迁移。"""
+        self.tables.append(Table(self.table_name, engine).enable_cache(self.result_cache, self.cache_ttl))
+        return self
+
+    def enable_cache(self, cache=None, ttl=None):
+        super(ShardedTable, self).enable_cache(cache, ttl)
+        for table in getattr(self, 'tables', ()):
+            table.enable_cache(cache, ttl)
+        return self
+
+    def shard(self, value):
+        """返回分片键值所在的分片序号。"""
+        return self.sharding(value, len(self.tables))
+
+    def select(self, *columns):
+        return _ShardedSession(self, 'SELECT', 'select', columns)
+
+    def insert(self, **assignments):
+        if self.key not in assignments:
+            raise ValueError('insert into a sharded table requires the shard key %s' % self.key)
+        return self.tables[self.shard(assignments[self.key])].insert(**assignments)
+
+    def update(self, **assignments):
+        return _ShardedSession(self, 'UPDATE', 'update', (), assignments)
+
+    def delete(self):
+        return _ShardedSession(self, 'DELETE', 'delete', ())
+
+    def count(self, column=None, distinct=None, approximate=False, exact_below=None, max_staleness=None):
+        if distinct and column is not None and str(column) != self.key:
+            raise ValueError('COUNT(DISTINCT) across shards is only exact for the shard key')
+        return _ShardedSession(self, 'COUNT', 'count', (column, distinct, approximate, exact_below, max_staleness))
+
+    def insert_many(self, rows, columns=None, max_rows=1000, max_packet=None):
+        return _ShardedBatch(self, 'insert_many', rows, columns, (), dict(max_rows=max_rows, max_packet=max_packet))
+
+    def upsert_many(self, rows, key=None, update=None, columns=None, max_rows=1000, max_packet=None):
+        return _ShardedBatch(self, 'upsert_many', rows, columns, (),
+                             dict(key=key, update=update, max_rows=max_rows, max_packet=max_packet))
+
+    def update_many(self, rows, key, columns=None, max_rows=1000, max_packet=None):
+        return _ShardedBatch(self, 'update_many', rows, columns, (key,), dict(max_rows=max_rows, max_packet=max_packet))
+
+    def scan(self, key, batch_size=1000, where=None, columns=None, start=None, slices=None):
+        """在各分片上按键值分页遍历，按键值归并为全局有序的行；key 应在所有分片中唯一。"""
+        return _ShardedScan(self, key, batch_size, where, columns, start, slices)
+
+    def load_from(self, *args, **kwargs):
+        raise TypeError('load_from() cannot route rows by shard key, '
+                        'use insert_many() or load each table in ShardedTable.tables')
+
+    def _pinned(self, condition):
+        """条件固定分片键时返回分片键的取值列表，否则返回 None。"""
+        if isinstance(condition, _InList):
+            if condition.column == self.key and not condition.negated:
+                return list(condition[1].values())
+            return None
+        clause, params = condition
+        if clause == '{0}=%({0}_eq)s'.format(self.key):
+            return [params[self.key + '_eq']]
+        return None
+
+
+class _ShardedSession(object):
+    """
+    ShardedTable 的会话：记录构造方法的调用，执行时在目标分片的会话上重放，
+    多个分片的结果按 ORDER BY 进行 k 路归并后应用 LIMIT，COUNT 与影响行数求和。
+    """
+    _BUILDERS = ('where', 'where_and', 'order', 'limit', 'distinct', 'group_by', 'clear', 'cached', 'chunk_in',
+                 'timeout', 'approximate')
+
+    def __init__(self, table, action, method, args, kwargs=None):
+        self.table, self.action = table, action
+        self._method, self._args, self._kwargs = method, args, kwargs or {}
+        self._calls, self._groups = [], []
+        self._order = self._limit = None
+        self._distinct = self._grouped = False
+        self.limit(1)   # the same default as a single table session
+
+    def __getattr__(self, name):
+        if name not in self._BUILDERS:
+            if not name.startswith('_') and hasattr(_Select, name):
+                raise TypeError('%s() is not supported across shards, run it on each table in ShardedTable.tables'
+                                % name)
+            raise AttributeError(name)
+
+        def builder(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            self._track(name, args, kwargs)
+            return self
+        return builder
+
+    def _track(self, name, args, kwargs):
+        """记录影响分片选择与结果合并的构造参数。"""
+        if name == 'where':
+            if not args:
+                self._groups = []
+            elif self._groups:
+                # WHERE (a) OR (b): each where() starts an OR branch
+                self._groups.append(list(args))
+            else:
+                self._groups = [list(args)]
+        elif name == 'where_and' and args:
+            if self._groups:
+                # (a) OR (b) AND (c) binds c to the last branch
+                self._groups[-1].extend(args)
+            else:
+                self._groups = [list(args)]
+        elif name == 'where_and':
+            self._groups = []
+        elif name == 'order':
+            column = args[0] if args else kwargs.get('column')
+            desc = args[1] if len(args) > 1 else kwargs.get('desc', False)
+            self._order = (str(column), desc) if column else None
+        elif name == 'limit':
+            number = args[0] if args else kwargs.get('number')
+            step = args[1] if len(args) > 1 else kwargs.get('step')
+            if number is None:
+                self._limit = None
+            else:
+                self._limit = (0, number) if step is None else (number, step)
+        elif name == 'distinct':
+            self._distinct = args[0] if args else kwargs.get('flag', True)
+        elif name == 'group_by':
+            self._grouped = True
+        elif name == 'clear':
+            self._groups, self._order, self._distinct = [], None, False
+            self._limit = (0, 1)
+
+    def targets(self):
+        """返回语句需要执行的分片序号列表。"""
+        everything = range(len(self.table.tables))
+        if len(self._groups) != 1:
+            return everything
+        pinned = None
+        for condition in self._groups[0]:
+            values = self.table._pinned(condition)
+            if values is not None:
+                shards = set([self.table.shard(value) for value in values])
+                pinned = shards if pinned is None else pinned & shards
+        return everything if pinned is None else sorted(pinned)
+
+    def _session(self, index, fan_out):
+        session = getattr(self.table.tables[index], self._method)(*self._args, **self._kwargs)
+        for name, args, kwargs in self._calls:
+            if fan_out and name == 'limit' and self._limit is not None:
+                # every shard may hold the rows of the merged page
+                offset, number = self._limit
+                args, kwargs = (offset + number,), {}
+            getattr(session, name)(*args, **kwargs)
+        return session
+
+    def go(self, cursor_class=None):
+        targets = self.targets()
+        if len(targets) == 1:
+            return self._session(targets[0], False).go(cursor_class)
+        if self._grouped:
+            raise ValueError('GROUP BY cannot be merged across shards, pin the shard key')
+        if self.action in ('UPDATE', 'DELETE') and self._limit is not None:
+            raise ValueError('%s with LIMIT cannot run across shards, pin the shard key or call limit()' % self.action)
+        sessions = [self._session(index, True) for index in targets]
+        results = _gather([lambda session=session: session.go(cursor_class) for session in sessions],
+                          len(sessions), None, False)
+        if self.action != 'SELECT':
+            return sum(results)
+        if self._order is not None:
+            rows = _merge_sorted(results, self._order[0], self._order[1], self._args)
+        else:
+            rows = chain(*results)
+        if self._distinct:
+            rows = _unique(rows)
+        if self._limit is not None:
+            offset, number = self._limit
+            rows = islice(rows, offset, offset + number)
+        return tuple(rows)
+
+
+def _row_getter(row, name, columns):
+    """返回读取行中字段 name 的函数，支持 dict, Record 与指定了字段的 tuple 行。"""
+    if isinstance(row, dict):
+        return itemgetter(name)
+    if isinstance(row, Record):
+        return itemgetter(row._index[name])
+    names = [str(column) for column in columns]
+    if name not in names:
+        raise ValueError('ORDER BY across shards needs dict or record rows, or %s among the selected columns' % name)
+    return itemgetter(names.index(name))
+
+
+class _Descending(object):
+    """反转比较顺序的排序键。"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _merge_sorted(results, name, desc, columns):
+    """对各分片已排序的结果做 k 路堆归并。"""
+    first = next((rows[0] for rows in results if rows), None)
+    if first is None:
+        return
+    getter = _row_getter(first, name, columns)
+    heap = []
+    for shard, rows in enumerate(results):
+        if rows:
+            heap.append(((_Descending(getter(rows[0])) if desc else getter(rows[0])), shard, 0))
+    heapify(heap)
+    while heap:
+        key, shard, position = heap[0]
+        rows = results[shard]
+        yield rows[position]
+        position += 1
+        if position < len(rows):
+            value = getter(rows[position])
+            heapreplace(heap, ((_Descending(value) if desc else value), shard, position))
+        else:
+            heappop(heap)
+
+
+def _unique(rows):
+    seen = set()
+    for row in rows:
+        key = tuple(sorted(row.items())) if isinstance(row, dict) else tuple(row)
+        if key not in seen:
+            seen.add(key)
+            yield row
+
+
+class _ShardedBatch(object):
+    """
+    ShardedTable 的批量写入：每次读取 max_rows × 分片数 行，按分片键分组后各分片并行执行，
+    因此 rows 可以是任意长度的可迭代对象。
+    """
+
+    def __init__(self, table, method, rows, columns, args, kwargs):
+        self.table, self._method, self._rows, self._columns = table, method, rows, columns
+        self._args, self._kwargs = args, kwargs
+
+    def go(self, cursor_class=None):
+        """返回 {'affected_rows': 各批影响行数, 'shards': {分片序号: 该分片 go() 的结果}}。"""
+        key = self.table.key
+        index = None
+        if self._columns:
+            names = [str(column) for column in self._columns]
+            if key not in names:
+                raise ValueError('columns must include the shard key %s' % key)
+            index = names.index(key)
+        window = self._kwargs['max_rows'] * len(self.table.tables)
+        rows, affected, merged = iter(self._rows), [], {}
+        while True:
+            groups = {}
+            for row in islice(rows, window):
+                if isinstance(row, dict):
+                    value = row[key]
+                elif index is None:
+                    raise ValueError('columns is required when rows are not dicts')
+                else:
+                    value = row[index]
+                groups.setdefault(self.table.shard(value), []).append(row)
+            if not groups:
+                break
+            shards = sorted(groups)
+            sessions = [getattr(self.table.tables[shard], self._method)(
+                groups[shard], *self._args, columns=self._columns, **self._kwargs) for shard in shards]
+            results = _gather([lambda session=session: session.go(cursor_class) for session in sessions],
+                              len(sessions), None, False)
+            for shard, result in zip(shards, results):
+                affected.extend(result['affected_rows'])
+                merged[shard] = _merge_batch(merged.get(shard), result)
+        return {'affected_rows': affected, 'shards': merged}
+
+
+def _merge_batch(previous, result):
+    """合并同一分片上多次批量写入的结果。"""
+    if previous is None:
+        return result
+    previous['affected_rows'].extend(result['affected_rows'])
+    if 'ids' in result:
+        previous['ids'].extend(result['ids'])
+    return previous
+
+
+class _ShardedScan(object):
+    """
+    ShardedTable.scan() 的结果：各分片的 _Scan 按键值 k 路归并，checkpoint 可作为 start 参数恢复遍历。
+    并行分段遍历时各分片的行不再有序，直接依次连接。
+    """
+
+    def __init__(self, table, key, batch_size, where, columns, start, slices):
+        self.scans = [shard.scan(key, batch_size, where, columns, start, slices) for shard in table.tables]
+        self.slices = slices
+        self.checkpoint = start
+
+    def __iter__(self):
+        if self.slices and self.slices > 1:
+            for row in chain(*self.scans):
+                yield row
+            return
+        heap = []
+        for index, scan in enumerate(self.scans):
+            rows = iter(scan)
+            for row in rows:
+                heap.append((scan._key(row), index, row, rows))
+                break
+        heapify(heap)
+        while heap:
+            key, index, row, rows = heap[0]
+            self.checkpoint = key
+            yield row
+            for row in rows:
+                heapreplace(heap, (self.scans[index]._key(row), index, row, rows))
+                break
+            else:
+                heappop(heap)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,737 @@
+# -*- coding: utf8 -*-
+"""
+lazy_mysql 的单元测试，使用 benchmarks/fakedb 中的 MySQLdb 替身，无需数据库服务器。
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+import unittest
+from decimal import Decimal
+from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'benchmarks', 'fakedb'), ROOT]
+
+import MySQLdb
+import lazy_mysql
+from MySQLdb.constants import FIELD_TYPE
+from lazy_mysql import (AsyncPool, Column, FutureTimeout, GatherError, MemoryInstrumentation, Param, Pool,
+                        PoolTimeout, QueryTimeout, ResultCache, RoutingPool, ShardedTable, Table, set_instrumentation)
+
+
+class FakeServer(object):
+    """记录收到的语句，按顺序返回 reply() 或 fail() 排入的结果或异常，其余语句返回 rows。"""
+
+    def __init__(self, rows=((1,),), description=(('id',),)):
+        self.rows, self.description = list(rows), list(description)
+        self.queries, self.pending = [], []
+        self.lock = threading.Lock()
+        self.answers = {}
+
+    def fail(self, *errors):
+        self.pending.extend(errors)
+
+    def reply(self, *rows):
+        self.pending.extend([{'rows': r, 'description': self.description, 'rowcount': len(r)} for r in rows])
+
+    def answer(self, prefix, result):
+        self.answers[prefix] = result
+
+    def __call__(self, sql):
+        with self.lock:
+            self.queries.append(sql)
+            if self.pending:
+                return self.pending.pop(0)
+        for prefix, result in self.answers.items():
+            if sql.startswith(prefix):
+                return result
+        return {'rows': self.rows, 'description': self.description, 'rowcount': 1, 'lastrowid': 1}
+
+
+class FakeServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        MySQLdb.responder, MySQLdb.latency = self.server, 0.0
+
+    def tearDown(self):
+        MySQLdb.responder, MySQLdb.latency = None, 0.0
+        set_instrumentation(None)
+
+    def pool(self, cls=Pool, **kwargs):
+        return cls('localhost', 'test', 'root', '', debug=False, **kwargs)
+
+
+class PoolTest(FakeServerTestCase):
+
+    def test_idle_engines_are_reused_lifo(self):
+        pool = self.pool(pool_size=2)
+        first, second = pool.get(), pool.get()
+        pool.put(first)
+        pool.put(second)
+        self.assertIs(pool.get(), second)
+        self.assertEqual(pool.stats(), {'count': 2, 'idle': 1, 'in_use': 1, 'waiting': 0})
+
+    def test_get_times_out_at_the_limit(self):
+        pool = self.pool(pool_size=1, extras=0)
+        pool.get()
+        self.assertRaises(PoolTimeout, pool.get, 0.05)
+        self.assertEqual(pool.stats()['waiting'], 0)
+
+    def test_put_hands_the_engine_to_a_waiter(self):
+        pool = self.pool(pool_size=1, extras=0)
+        engine, got = pool.get(), []
+        waiter = threading.Thread(target=lambda: got.append(pool.get(2)))
+        waiter.start()
+        while not pool.stats()['waiting']:
+            time.sleep(0.001)
+        pool.put(engine)
+        waiter.join(2)
+        self.assertEqual(got, [engine])
+
+    def test_pinged_engines_still_expire(self):
+        now = [0.0]
+        clock, lazy_mysql._clock = lazy_mysql._clock, lambda: now[0]
+        try:
+            pool = self.pool(pool_size=3, max_idle_time=60, maintenance_interval=30)
+            engines = [pool.get() for _ in range(3)]
+            for engine in engines:
+                engine.connect()
+                pool.put(engine)
+            while now[0] < 300:
+                now[0] += 30
+                pool._maintain()
+            self.assertEqual(pool.stats(), {'count': 0, 'idle': 0, 'in_use': 0, 'waiting': 0})
+            pool.close()
+        finally:
+            lazy_mysql._clock = clock
+
+    def test_old_connections_are_replaced(self):
+        now = [0.0]
+        clock, lazy_mysql._clock = lazy_mysql._clock, lambda: now[0]
+        try:
+            pool = self.pool(pool_size=1, max_lifetime=100)
+            engine = pool.get()
+            old = engine.connect()
+            pool.put(engine)
+            now[0] = 120
+            pool._maintain()
+            self.assertIsNot(pool.get().connection, old)
+            pool.close()
+        finally:
+            lazy_mysql._clock = clock
+
+    def test_min_idle_connections_are_opened(self):
+        pool = self.pool(pool_size=3, min_idle=2)
+        deadline = time.time() + 2
+        while pool.stats()['idle'] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.stats()['idle'], 2)
+        self.assertTrue(all(engine.connection is not None for engine in pool.pool))
+        pool.close()
+
+    def test_concurrent_sessions_with_instrumentation(self):
+        set_instrumentation(MemoryInstrumentation())
+        table = Table('t', self.pool(pool_size=2, extras=30), Column('id'))
+
+        def work():
+            for _ in range(500):
+                table.select().go()
+        threads = [threading.Thread(target=work) for _ in range(16)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        deadline = time.time() + 10
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+        self.assertFalse([thread for thread in threads if thread.is_alive()], 'checkout deadlocked')
+        self.assertEqual(lazy_mysql.get_instrumentation().snapshot()['counters']['checkouts'], 8000)
+
+
+class ForkTest(FakeServerTestCase):
+
+    def fork(self, child):
+        """在子进程中执行 child，返回它是否正常结束。"""
+        pid = os.fork()
+        if not pid:
+            code = 1
+            try:
+                child()
+                code = 0
+            finally:
+                os._exit(code)
+        return os.waitpid(pid, 0)[1] == 0
+
+    def test_inherited_sockets_are_pointed_at_devnull(self):
+        pool, (read, write) = self.pool(pool_size=1), os.pipe()
+        engine = pool.get()
+        engine.connect().fileno = lambda: write
+        pool.put(engine)
+
+        def child():
+            assert pool.stats() == {'count': 0, 'idle': 0, 'in_use': 0, 'waiting': 0}
+            os.write(write, b'QUIT')
+        self.assertTrue(self.fork(child))
+        os.close(write)
+        self.assertEqual(os.read(read, 16), b'')
+        os.close(read)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+    def test_driver_without_fileno_fails_loudly(self):
+        pool = self.pool(pool_size=1)
+        engine = pool.get()
+        engine.connect()
+        pool.put(engine)
+
+        def child():
+            try:
+                pool.get()
+            except RuntimeError:
+                assert pool.pool == [engine] and engine.connection is not None
+            else:
+                raise AssertionError('after_fork() dropped a connection it could not detach')
+        self.assertTrue(self.fork(child))
+
+
+class SessionTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(SessionTest, self).setUp()
+        self.table = Table('t', self.pool(), Column('id'), Column('name'))
+
+    def test_select_gets_max_execution_time_hint(self):
+        self.table.select('id').where(self.table.id == 3).timeout(500).go()
+        self.assertEqual(self.server.queries[-1], 'SELECT /*+ MAX_EXECUTION_TIME(500) */ id FROM t WHERE (id=3) LIMIT 1')
+
+    def test_timeout_is_not_retried(self):
+        self.server.fail(MySQLdb.OperationalError(3024, 'maximum statement execution time exceeded'))
+        self.assertRaises(QueryTimeout, self.table.select().timeout(10).go)
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_sql_error_is_not_retried(self):
+        self.server.fail(MySQLdb.ProgrammingError(1064, 'syntax error'))
+        self.assertRaises(MySQLdb.ProgrammingError, self.table.select().go)
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_lost_connection_is_retried_once(self):
+        self.server.fail(MySQLdb.OperationalError(2006, 'MySQL server has gone away'))
+        self.assertEqual(self.table.select().go(), ({'id': 1},))
+        self.assertEqual(len(self.server.queries), 2)
+
+
+class TransactionTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(TransactionTest, self).setUp()
+        self.engines = self.pool(pool_size=2)
+        self.table = Table('t', self.engines, Column('id'))
+        self.calls = []
+        for name in ('commit', 'rollback'):
+            self.addCleanup(setattr, MySQLdb.Connection, name, getattr(MySQLdb.Connection, name))
+            setattr(MySQLdb.Connection, name, lambda connection, name=name: self.calls.append(name))
+
+    def test_statements_share_one_engine_and_commit_once(self):
+        with self.engines.transaction() as tx:
+            self.table.insert(id=1).go()
+            self.table.select().go()
+            self.assertEqual(self.engines.stats()['in_use'], 1)
+            self.assertFalse(tx.engine.connection.get_autocommit())
+        self.assertEqual(self.calls, ['commit'])
+        self.assertTrue(tx.engine.connection.get_autocommit())
+        self.assertEqual(self.engines.stats()['in_use'], 0)
+
+    def test_exception_rolls_back(self):
+        def fail():
+            with self.engines.transaction():
+                self.table.insert(id=1).go()
+                raise KeyError('boom')
+        self.assertRaises(KeyError, fail)
+        self.assertEqual(self.calls, ['rollback'])
+
+    def test_nested_blocks_use_savepoints(self):
+        with self.engines.transaction():
+            with self.engines.transaction():
+                pass
+            try:
+                with self.engines.transaction():
+                    raise KeyError('boom')
+            except KeyError:
+                pass
+        self.assertEqual(self.server.queries, ['SAVEPOINT `sp_1`', 'RELEASE SAVEPOINT `sp_1`',
+                                               'SAVEPOINT `sp_2`', 'ROLLBACK TO SAVEPOINT `sp_2`'])
+        self.assertEqual(self.calls, ['commit'])
+
+
+class PipelineTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(PipelineTest, self).setUp()
+        self.engines = self.pool(pool_size=1)
+        self.table = Table('t', self.engines, Column('id'))
+
+    def test_statements_go_in_one_round_trip(self):
+        self.server.pending.append([{'rows': [(1,)], 'description': [('id',)]},
+                                    {'rows': [(5,)], 'description': [('X',)]},
+                                    {'rowcount': 1, 'lastrowid': 7}])
+        pipeline = self.engines.pipeline().add(self.table.select(), self.table.count(), self.table.insert(id=3))
+        self.assertEqual(pipeline.go(), [({'id': 1},), 5, 7])
+        self.assertEqual(self.server.queries, ["SELECT * FROM t LIMIT 1;\nSELECT COUNT( '*') AS X FROM t LIMIT 1;\n"
+                                               "INSERT INTO t SET id=3"])
+
+    def test_missing_result_set_drops_the_connection(self):
+        self.server.pending.append([{'rows': [(1,)], 'description': [('id',)]}])
+        pipeline = self.engines.pipeline().add(self.table.select(), self.table.select())
+        self.assertRaises(MySQLdb.InterfaceError, pipeline.go)
+        self.assertIsNone(self.engines.pool[0].connection)
+
+    def test_only_builder_sessions_are_accepted(self):
+        self.assertRaises(TypeError, self.engines.pipeline().add, self.table.insert_many([]))
+
+
+class GatherTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(GatherTest, self).setUp()
+        self.engines = self.pool(pool_size=4, extras=0)
+
+    def test_queries_run_in_parallel(self):
+        MySQLdb.latency = 0.1
+        table = Table('t', self.engines, Column('id'))
+        started = time.time()
+        results = self.engines.gather([table.select() for _ in range(4)])
+        self.assertLess(time.time() - started, 0.3)
+        self.assertEqual(results, [({'id': 1},)] * 4)
+
+    def test_map_keeps_the_input_order(self):
+        self.assertEqual(self.engines.map(lambda n: time.sleep(n / 100.0) or n, [3, 1, 2]), [3, 1, 2])
+
+    def test_errors_are_collected(self):
+        def work(n):
+            if n == 1:
+                raise KeyError(n)
+            return n
+        self.assertIsInstance(self.engines.map(work, [0, 1], return_exceptions=True)[1], KeyError)
+        try:
+            self.engines.map(work, [0, 1, 2])
+        except GatherError as e:
+            self.assertEqual((e.results, list(e.errors)), ([0, None, 2], [1]))
+        else:
+            self.fail('GatherError not raised')
+
+    def test_timeout(self):
+        results = self.engines.map(lambda n: time.sleep(n), [0, 0.5], timeout=0.05, return_exceptions=True)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], FutureTimeout)
+
+
+class CompileTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(CompileTest, self).setUp()
+        self.table = Table('t', self.pool(), Column('id'), Column('name'))
+
+    def test_params_are_bound_per_run(self):
+        query = self.table.select('name').where(self.table.id == Param('id'), self.table.name != 'x').compile()
+        query.go(id=3)
+        query.go(id=4)
+        self.assertEqual(self.server.queries, ["SELECT name FROM t WHERE (id=3 AND name<>'x') LIMIT 1",
+                                               "SELECT name FROM t WHERE (id=4 AND name<>'x') LIMIT 1"])
+
+    def test_compiled_selects_use_the_result_cache(self):
+        self.table.enable_cache(ResultCache())
+        query = self.table.select().where(self.table.id == Param('id')).compile()
+        self.assertEqual(query.go(id=1), query.go(id=1))
+        query.go(id=2)
+        self.assertEqual(len(self.server.queries), 2)
+
+
+class ChunkInTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(ChunkInTest, self).setUp()
+        self.table = Table('t', self.pool(), Column('id'))
+
+    def test_long_lists_run_in_chunks(self):
+        self.server.rows = [(1,), (2,)]
+        rows = self.table.select().where(self.table.id.in_(*range(5))).limit().chunk_in(2).go()
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(self.server.queries, ['SELECT * FROM t WHERE (id IN (0,1))',
+                                               'SELECT * FROM t WHERE (id IN (2,3))',
+                                               'SELECT * FROM t WHERE (id IN (4))'])
+
+    def test_parallel_chunks(self):
+        self.server.rows = [(1,)]
+        select = self.table.select().where(self.table.id.in_(*range(5))).limit()
+        self.assertEqual(select.chunk_in(2, parallel=True).go(), ({'id': 1},) * 3)
+        self.assertEqual(sorted(self.server.queries), ['SELECT * FROM t WHERE (id IN (0,1))',
+                                                       'SELECT * FROM t WHERE (id IN (2,3))',
+                                                       'SELECT * FROM t WHERE (id IN (4))'])
+
+    def test_updates_add_up_affected_rows(self):
+        self.assertEqual(self.table.update(id=0).where(self.table.id.in_(*range(5))).limit().chunk_in(2).go(), 3)
+
+    def test_limit_and_not_in_run_as_one_statement(self):
+        self.table.select().where(self.table.id.in_(*range(5))).limit(10).chunk_in(2).go()
+        self.table.select().where(self.table.id.not_in(*range(5))).limit().chunk_in(2).go()
+        self.assertEqual(len(self.server.queries), 2)
+
+    def test_temporary_tables_share_one_shape(self):
+        set_instrumentation(MemoryInstrumentation())
+        for _ in range(3):
+            self.table.select().where(self.table.id.in_(*range(5))).limit().chunk_in(2, temporary=True).go()
+        shapes = sorted(lazy_mysql.get_instrumentation().snapshot()['statements'])
+        self.assertEqual(shapes, ['CREATE TEMPORARY TABLE _lazy_in_? (INDEX (v)) SELECT id AS v FROM t LIMIT 0',
+                                  'DROP TEMPORARY TABLE _lazy_in_?',
+                                  'INSERT INTO _lazy_in_? (v) VALUES (...)',
+                                  'SELECT * FROM t WHERE (id IN (SELECT v FROM _lazy_in_?))'])
+
+
+class ResultCacheTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(ResultCacheTest, self).setUp()
+        self.cache = ResultCache(ttl=60)
+        self.table = Table('t', self.pool(pool_size=8), Column('id')).enable_cache(self.cache)
+
+    def test_concurrent_misses_run_one_query(self):
+        MySQLdb.latency = 0.05
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.table.select().go())) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(results, [({'id': 1},)] * 8)
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_writes_invalidate_the_table(self):
+        self.table.select().go()
+        self.table.select().go()
+        self.table.insert(id=2).go()
+        self.table.select().go()
+        self.assertEqual([sql.split()[0] for sql in self.server.queries], ['SELECT', 'INSERT', 'SELECT'])
+        self.assertEqual(self.cache.info()['hits'], 1)
+
+    def test_result_loaded_across_an_invalidation_is_not_stored(self):
+        def load():
+            self.cache.invalidate('t')
+            return 1
+        self.cache.get('k', 't', load)
+        self.assertEqual(self.cache.info()['entries'], 0)
+
+    def test_entries_expire(self):
+        now = [0.0]
+        clock, lazy_mysql._clock = lazy_mysql._clock, lambda: now[0]
+        try:
+            self.cache.get('k', 't', lambda: 1, ttl=10)
+            now[0] = 11
+            self.assertEqual(self.cache.get('k', 't', lambda: 2), 2)
+        finally:
+            lazy_mysql._clock = clock
+
+
+class CountTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(CountTest, self).setUp()
+        self.server.rows, self.server.description = [(42,)], [('X',)]
+
+    def test_approximate_reads_table_rows(self):
+        self.server.answer('SELECT TABLE_ROWS', {'rows': [(1000,)], 'description': [('X',)]})
+        self.assertEqual(Table('db.t', self.pool()).count(approximate=True).go(), 1000)
+        self.assertIn("TABLE_SCHEMA = 'db' AND TABLE_NAME = 't'", self.server.queries[-1])
+
+    def test_approximate_falls_back_without_estimate(self):
+        self.server.answer('SELECT TABLE_ROWS', {'rows': [], 'description': [('X',)]})
+        self.assertEqual(Table('t', self.pool()).count(approximate=True).go(), 42)
+
+    def test_exact_below_counts_small_estimates(self):
+        self.server.answer('SELECT TABLE_ROWS', {'rows': [(10,)], 'description': [('X',)]})
+        self.assertEqual(Table('t', self.pool()).count(approximate=True, exact_below=100).go(), 42)
+
+
+class RoutingPoolTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(RoutingPoolTest, self).setUp()
+        self.routing = RoutingPool(self.pool(), [self.pool()], retry_after=30)
+        self.table = Table('t', self.routing, Column('id'))
+
+    def available(self):
+        return self.routing.replicas[0].available(lazy_mysql._clock())
+
+    def test_sql_errors_keep_the_replica(self):
+        for error in (MySQLdb.ProgrammingError(1064, 'syntax error'), QueryTimeout(3024, 'timeout')):
+            self.server.fail(error)
+            self.assertRaises(MySQLdb.Error, self.table.select().go)
+        self.assertTrue(self.available())
+
+    def test_lost_connection_takes_the_replica_out(self):
+        self.server.fail(MySQLdb.OperationalError(2013, 'lost connection'), MySQLdb.OperationalError(2003, 'refused'))
+        self.assertRaises(MySQLdb.OperationalError, self.table.select().go)
+        self.assertFalse(self.available())
+
+    def test_busy_replica_stays_in_rotation(self):
+        routing = RoutingPool(self.pool(), [self.pool(pool_size=1, extras=0, wait_time=0.05)], retry_after=30)
+        held = routing.get('SELECT')
+        self.assertRaises(PoolTimeout, routing.get, 'SELECT')
+        self.assertTrue(routing.replicas[0].available(lazy_mysql._clock()))
+        routing.put(held)
+
+
+class InsertManyTest(FakeServerTestCase):
+
+    def test_ids_are_reported_per_batch(self):
+        self.server.pending.extend([{'rowcount': 2, 'lastrowid': 10}, {'rowcount': 1, 'lastrowid': 20}])
+        table = Table('t', self.pool())
+        result = table.insert_many([{'name': n} for n in 'abc'], max_rows=2, max_packet=4096).go()
+        self.assertEqual(result, {'affected_rows': [2, 1], 'ids': [(10, 11), (20, 20)]})
+        self.assertEqual(self.server.queries, ["INSERT INTO t (name) VALUES ('a'),('b')",
+                                               "INSERT INTO t (name) VALUES ('c')"])
+
+    def test_no_auto_increment(self):
+        self.server.pending.append({'rowcount': 1, 'lastrowid': 0})
+        result = Table('t', self.pool()).insert_many([(1,)], columns=['id'], max_packet=4096).go()
+        self.assertEqual(result['ids'], [(None, None)])
+
+
+class UpsertManyTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(UpsertManyTest, self).setUp()
+        self.table = Table('t', self.pool())
+
+    def test_upsert_updates_non_key_fields(self):
+        result = self.table.upsert_many([(1, 'a'), (2, 'b')], key='id', columns=['id', 'name'], max_packet=4096).go()
+        self.assertEqual(result, {'affected_rows': [1]})
+        self.assertEqual(self.server.queries, [
+            "INSERT INTO t (id, name) VALUES (1,'a'),(2,'b') ON DUPLICATE KEY UPDATE name=VALUES(name)"])
+
+    def test_update_many_with_composite_key(self):
+        self.table.update_many([(1, 2, 'a'), (1, 3, 'b')], key=('a', 'b'), columns=['a', 'b', 'name'],
+                               max_packet=4096).go()
+        self.assertEqual(self.server.queries, [
+            "UPDATE t SET name = CASE WHEN (a=1 AND b=2) THEN 'a' WHEN (a=1 AND b=3) THEN 'b' ELSE name END "
+            "WHERE (a, b) IN ((1,2),(1,3))"])
+
+    def test_update_many_needs_the_key(self):
+        self.assertRaises(ValueError, self.table.update_many([{'name': 'a'}], key='id').go)
+
+
+class ShardedTableTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(ShardedTableTest, self).setUp()
+        self.table = ShardedTable('t', [self.pool(), self.pool()], 'id', None, Column('id'))
+
+    def test_pinned_statements_go_to_one_shard(self):
+        t = self.table
+        self.assertEqual(t.select().where(t.id == 5).targets(), [1])
+        self.assertEqual(t.select().where(t.id.in_(2, 4)).targets(), [0])
+        self.assertEqual(t.select().where(t.id == 5).where(t.id == 6).targets(), [0, 1])
+        t.select().where(t.id == 5).go()
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_ordered_pages_are_merged(self):
+        self.server.rows = [(1,), (3,)]
+        rows = self.table.select().order(self.table.id).limit(3).go()
+        self.assertEqual([row['id'] for row in rows], [1, 1, 3])
+        self.assertEqual(self.server.queries, ['SELECT * FROM t ORDER BY id ASC LIMIT 3'] * 2)
+
+    def test_counts_are_summed(self):
+        self.server.rows, self.server.description = [(42,)], [('X',)]
+        self.assertEqual(self.table.count().go(), 84)
+
+    def test_group_by_needs_the_shard_key(self):
+        self.assertRaises(ValueError, self.table.select().group_by('name').limit().go)
+
+    def test_batches_are_routed_by_key(self):
+        result = self.table.insert_many([{'id': i} for i in range(4)], max_packet=4096).go()
+        self.assertEqual(sorted(self.server.queries), ['INSERT INTO t (id) VALUES (0),(2)',
+                                                       'INSERT INTO t (id) VALUES (1),(3)'])
+        self.assertEqual(sorted(result['shards']), [0, 1])
+
+
+class BufferedWriterTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(BufferedWriterTest, self).setUp()
+        self.server.answer('SELECT @@max_allowed_packet', {'rows': [(4096,)], 'description': [('X',)]})
+        self.table = Table('t', self.pool())
+
+    def inserts(self):
+        return [sql for sql in self.server.queries if sql.startswith('INSERT')]
+
+    def test_flush_writes_one_statement(self):
+        writer = self.table.buffered_writer(max_rows=100, max_delay_ms=10000)
+        for i in range(3):
+            writer.insert(id=i)
+        self.assertTrue(writer.flush(2))
+        self.assertEqual(self.inserts(), ['INSERT INTO t (id) VALUES (0),(1),(2)'])
+        self.assertEqual(writer.written, 3)
+        writer.close()
+
+    def test_full_batch_is_written_without_flush(self):
+        writer = self.table.buffered_writer(max_rows=2, max_delay_ms=10000)
+        writer.insert(id=1)
+        writer.insert(id=2)
+        deadline = time.time() + 2
+        while writer.written < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.inserts(), ['INSERT INTO t (id) VALUES (1),(2)'])
+        writer.close()
+
+    def test_close_writes_the_rest(self):
+        with self.table.buffered_writer(max_delay_ms=10000) as writer:
+            writer.insert(id=1, name='a')
+            writer.insert(id=2)
+        self.assertEqual(self.inserts(), ["INSERT INTO t (id, name) VALUES (1,'a')", 'INSERT INTO t (id) VALUES (2)'])
+        self.assertRaises(ValueError, writer.insert, id=3)
+
+    def test_failed_rows_go_to_on_error(self):
+        failures = []
+        self.server.answer('INSERT', MySQLdb.ProgrammingError(1146, "table doesn't exist"))
+        writer = self.table.buffered_writer(on_error=lambda e, rows: failures.append((e.args[0], rows)))
+        writer.insert(id=1)
+        writer.close()
+        self.assertEqual((failures, writer.failed), ([(1146, [{'id': 1}])], 1))
+
+
+class LoadExportTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(LoadExportTest, self).setUp()
+        self.table = Table('t', self.pool(local_infile=True))
+        self.server.rows, self.server.description = [(1, 'a "b"'), (2, None)], [('id',), ('name',)]
+
+    def test_rows_are_loaded_through_a_temporary_file(self):
+        loaded = []
+
+        def respond(sql):
+            path = re.search(r"INFILE '([^']+)'", sql).group(1)
+            with open(path) as data:
+                loaded.append((path, data.read()))
+            self.server(sql)
+            return {'rowcount': 2}
+        MySQLdb.responder = respond
+        result = self.table.load_from(self.server.rows, columns=['id', 'name']).go()
+        (path, data), = loaded
+        self.assertEqual(data, '1,"a ""b"""\n2,NULL\n')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(result['rows'], 2)
+        self.assertTrue(self.server.queries[0].endswith(" LINES TERMINATED BY '\\n' (id, name)"))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, self.table.load_from, [], format='xml')
+        self.assertRaises(ValueError, self.table.select().export_to, StringIO(), 'xml')
+
+    def test_export_formats(self):
+        for format, expected in (('csv', '1,"a ""b"""\n2,NULL\n'), ('tsv', '1\ta "b"\n2\t\\N\n')):
+            output = StringIO()
+            self.assertEqual(self.table.select().limit().export_to(output, format, chunk_size=1)['rows'], 2)
+            self.assertEqual(output.getvalue(), expected)
+        output = StringIO()
+        self.table.select().limit().export_to(output, 'jsonl')
+        self.assertEqual([json.loads(line) for line in output.getvalue().splitlines()],
+                         [{'id': 1, 'name': 'a "b"'}, {'id': 2, 'name': None}])
+
+
+class ScanTest(FakeServerTestCase):
+
+    def test_checkpoint_is_the_row_being_handled(self):
+        self.server.reply([(1,), (2,)], [(3,)])
+        scanner = Table('t', self.pool(), Column('id')).scan('id', batch_size=2)
+        self.assertEqual([(row['id'], scanner.checkpoint) for row in scanner], [(1, 1), (2, 2), (3, 3)])
+        self.assertIn('(id>2)', self.server.queries[-1])
+
+    def test_sharded_checkpoint_follows_the_merge(self):
+        self.server.reply([(1,), (4,)], [(2,), (3,)])
+        scanner = ShardedTable('t', [self.pool(), self.pool()], 'id').scan('id', batch_size=10)
+        self.assertEqual([(row['id'], scanner.checkpoint) for row in scanner], [(1, 1), (2, 2), (3, 3), (4, 4)])
+
+
+class RowFormatTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(RowFormatTest, self).setUp()
+        self.server.rows, self.server.description = [(1, 2, 3)], [('id',), ('count',), ('a b',)]
+
+    def test_record_rows(self):
+        row, = Table('t', self.pool()).select().go('record')
+        self.assertEqual(row, (1, 2, 3))
+        self.assertEqual((row.id, row['count'], row['a b'], row.get('missing')), (1, 2, 3, None))
+        self.assertEqual(row.as_dict(), {'id': 1, 'count': 2, 'a b': 3})
+        self.assertEqual(row.count(2), 1)
+
+    def test_pool_row_format(self):
+        self.assertEqual(Table('t', self.pool(cursor_class='tuple')).select().go(), ((1, 2, 3),))
+        row, = Table('t', self.pool(cursor_class='record')).select().go()
+        self.assertIs(type(row), type(Table('t', self.pool()).select().go('record')[0]))
+
+
+class IterTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(IterTest, self).setUp()
+        self.server.rows = [(i,) for i in range(5)]
+        self.table = Table('t', self.pool(pool_size=1), Column('id'))
+
+    def test_rows_stream_in_chunks(self):
+        chunks = list(self.table.select().limit().iter(chunk_size=2, chunked=True, cursor_class='tuple'))
+        self.assertEqual(chunks, [[(0,), (1,)], [(2,), (3,)], [(4,)]])
+        self.assertEqual([row['id'] for row in self.table.select().limit().iter(chunk_size=2)], range(5))
+        self.assertEqual(self.table.engine.stats()['in_use'], 0)
+
+    def test_closed_iterator_drops_the_unread_connection(self):
+        rows = self.table.select().limit().iter(chunk_size=2)
+        next(rows)
+        self.assertEqual(self.table.engine.stats()['in_use'], 1)
+        rows.close()
+        self.assertEqual(self.table.engine.stats(), {'count': 1, 'idle': 1, 'in_use': 0, 'waiting': 0})
+        self.assertIsNone(self.table.engine.pool[0].connection)
+
+
+class ColumnarTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(ColumnarTest, self).setUp()
+        self.server.description = [('id', FIELD_TYPE.LONGLONG), ('price', FIELD_TYPE.NEWDECIMAL)]
+        self.table = Table('t', self.pool(), Column('id'), Column('price'))
+
+    def test_unsigned_bigint_falls_back_to_objects(self):
+        self.server.rows = [(1, Decimal('0.10')), (None, None), (2 ** 64 - 1, Decimal('2.25'))]
+        result = self.table.select().limit().go_columnar(use_numpy=False)
+        self.assertEqual(result['id'], [1, None, 2 ** 64 - 1])
+        self.assertEqual(list(result.masks['id']), [0, 1, 0])
+
+    def test_decimal_keeps_exact_values(self):
+        self.server.rows = [(1, Decimal('0.10')), (2, Decimal('2.25'))]
+        result = self.table.select().limit().go_columnar(use_numpy=False)
+        self.assertEqual(result['price'], [Decimal('0.10'), Decimal('2.25')])
+        self.assertEqual(result['id'].typecode, 'l')
+
+
+class AsyncPoolTest(FakeServerTestCase):
+
+    def test_dropped_iterators_return_their_engines(self):
+        self.server.rows = [(i,) for i in range(100)]
+        pool = self.pool(AsyncPool, pool_size=1, extras=1)
+        table = Table('t', pool, Column('id'))
+        for _ in range(2):
+            for row in table.select().limit().iter_async(chunk_size=2, prefetch=1):
+                break
+        deadline = time.time() + 2
+        while pool.stats()['in_use'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.stats()['in_use'], 0)
+        self.assertEqual(len(table.select().limit().go_async().result(timeout=2)), 100)
+        pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()